@@ -11,12 +11,21 @@ def junit(t):
                               errors = str(len(t.framework_failures)),
                               timestamp = datetime.now().isoformat())
 
+    # See Note [Result cache] in testlib.py.
+    cached = set((testname, way) for (_, testname, way) in t.cached_results)
+
+    def mark_cached(testcase, testname, way):
+        if (testname, way) in cached:
+            properties = ET.SubElement(testcase, 'properties')
+            ET.SubElement(properties, 'property', name='cached', value='true')
+
     for res_type, group in [('stat failure', t.unexpected_stat_failures),
                           ('unexpected failure', t.unexpected_failures)]:
         for (directory, testname, reason, way) in group:
             testcase = ET.SubElement(testsuite, 'testcase',
                                      classname = way,
                                      name = '%s(%s)' % (testname, way))
+            mark_cached(testcase, testname, way)
             result = ET.SubElement(testcase, 'failure',
                                    type = res_type,
                                    message = reason)
@@ -33,6 +42,7 @@ def junit(t):
         testcase = ET.SubElement(testsuite, 'testcase',
                                  classname = way,
                                  name = '%s(%s)' % (testname, way))
+        mark_cached(testcase, testname, way)
 
     return ET.ElementTree(testsuites)
 
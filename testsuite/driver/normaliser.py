@@ -0,0 +1,63 @@
+#
+# Normalisers made of substitution rules that are compiled once, and that
+# skip the texts they can't change. See Note [Compiled normalisers] in
+# testlib.py.
+#
+
+import re
+
+# A substitution, like re.sub(pattern, replacement, text). The pattern is
+# a regular expression (a string or compiled), and the replacement a
+# template or a function of the match. If a needle is given, every match
+# contains it, and texts without it are left alone without a scan for the
+# pattern. A pattern without special characters (and a replacement
+# without backslashes) is replaced with str.replace.
+class Rule:
+    def __init__(self, pattern, replacement, needle=None):
+        self.pattern = pattern
+        self.replacement = replacement
+        self.needle = needle
+        if isinstance(pattern, str) and re.escape(pattern) == pattern \
+           and isinstance(replacement, str) and '\\' not in replacement:
+            self.literal = True
+        else:
+            self.literal = False
+            self.regex = re.compile(pattern)
+
+    def __call__(self, s):
+        if self.needle is not None and self.needle not in s:
+            return s
+        if self.literal:
+            return s.replace(self.pattern, self.replacement)
+        return self.regex.sub(self.replacement, s)
+
+# The characters that str.splitlines splits at, besides '\n'.
+_line_breaks = '\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
+# Split the text into lines and join them again with '\n': all line
+# breaks become '\n', and a text ending in an empty line loses it. The
+# first half of modify_lines in testlib.py, without modifying the lines.
+def join_lines(s):
+    if any(c in s for c in _line_breaks):
+        return '\n'.join(s.splitlines())
+    if s.endswith('\n'):
+        return s[:-1]
+    return s
+
+# End the text with a newline if it isn't empty. The second half of
+# modify_lines.
+def end_lines(s):
+    if s and s[-1] != '\n':
+        # Prevent '\ No newline at end of file' warnings when diffing.
+        s += '\n'
+    return s
+
+# A sequence of steps: rules, or any functions from text to text.
+class Normaliser:
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+    def __call__(self, s):
+        for step in self.steps:
+            s = step(s)
+        return s
@@ -10,11 +10,15 @@
 #
 
 import argparse
+import os
 import re
+import sqlite3
 import subprocess
+import threading
 import time
 
 from collections import namedtuple
+from contextlib import contextmanager
 from math import ceil, trunc
 
 from testutil import passed, failBecause
@@ -60,19 +64,295 @@ def parse_perf_stat(stat_str):
     field_vals = stat_str.strip('\t').split('\t')
     return PerfStat(*field_vals)
 
-# Get all recorded (in a git note) metrics for a given commit.
+# Get all recorded metrics (in a git note, or in the metrics backend, see
+# Note [Metrics backends]) for a given commit.
 # Returns an empty array if the note is not found.
 def get_perf_stats(commit='HEAD', namespace='perf'):
+    return metrics_backend.get_perf_stats([commit], namespace)[commit]
+
+# Get the recorded metrics of many commits at once, as a dictionary from
+# commit to metrics.
+def get_perf_stats_of(commits, namespace='perf'):
+    return metrics_backend.get_perf_stats(commits, namespace)
+
+# The metrics of a commit, as a baseline for the metrics of the tests: the
+# tests that have metrics, and the average value of every metric of every
+# test, over all ways and test environments. See Note [Baselines].
+class Baseline:
+    def __init__(self, stats):
+        values = {}
+        for stat in stats:
+            values.setdefault((stat.test, stat.metric), []).append(float(stat.value))
+        self.tests = set(test for (test, metric) in values)
+        self.averages = dict((key, sum(vals) / len(vals))
+                             for (key, vals) in values.items())
+
+    def has_test(self, test):
+        return test in self.tests
+
+    def average(self, test, metric):
+        return self.averages[(test, metric)]
+
+# Note [Baselines]
+#
+# The setup functions of the performance tests (collect_stats in
+# testlib.py) compare the metrics of a test with the ones of the previous
+# commit. Instead of reading the metrics of the commit (e.g. running
+# `git notes show`) and going through all of them for each of them,
+# get_baseline reads them once per process, and indexes them in a
+# Baseline.
+#
+# A Baseline is forgotten when the driver appends metrics to the same
+# namespace (see append_perf_stat), or switches to another metrics
+# backend (see Note [Metrics backends]).
+
+baselines = {}
+baselines_lock = threading.Lock()
+
+def get_baseline(commit='HEAD', namespace='perf'):
+    with baselines_lock:
+        baseline = baselines.get((commit, namespace))
+        if baseline is None:
+            baseline = Baseline(get_perf_stats(commit, namespace))
+            baselines[(commit, namespace)] = baseline
+        return baseline
+
+def parse_note(note):
+    log = note.strip('\n').split('\n')
+    log = list(filter(None, log))
+    return [parse_perf_stat(stat_str) for stat_str in log]
+
+# Get all metrics recorded in the git note of a given commit.
+def get_note_stats(commit='HEAD', namespace='perf'):
     try:
         log = subprocess.check_output(['git', 'notes', '--ref=' + namespace, 'show', commit], stderr=subprocess.STDOUT).decode('utf-8')
     except subprocess.CalledProcessError:
         return []
 
-    log = log.strip('\n').split('\n')
-    log = list(filter(None, log))
-    log = [parse_perf_stat(stat_str) for stat_str in log]
-    return log
+    return parse_note(log)
+
+# Get the metrics in all git notes of the namespace, as a dictionary from
+# commit (hash) to metrics. Reads all notes with a single git process.
+def get_all_note_stats(namespace='perf'):
+    try:
+        listing = subprocess.check_output(['git', 'notes', '--ref=' + namespace, 'list'], stderr=subprocess.DEVNULL).decode('utf-8')
+    except subprocess.CalledProcessError:
+        return {}
+
+    notes = [line.split() for line in listing.splitlines() if line]
+    batch = subprocess.run(['git', 'cat-file', '--batch'],
+                           input=''.join(note + '\n' for (note, _) in notes).encode('utf-8'),
+                           stdout=subprocess.PIPE, check=True).stdout
+
+    # Every note is a header line '<object> blob <size>', its contents and
+    # a newline.
+    stats = {}
+    pos = 0
+    for (_, commit) in notes:
+        header_end = batch.index(b'\n', pos)
+        size = int(batch[pos:header_end].split()[2])
+        contents = batch[header_end + 1:header_end + 1 + size]
+        stats[commit] = parse_note(contents.decode('utf-8'))
+        pos = header_end + 1 + size + 1
+    return stats
+
+# The full hashes of the given commits (any names git knows), as a
+# dictionary. Commits that git doesn't know are left out.
+def resolve_commits(commits):
+    hashes = {}
+    names = []
+    for commit in commits:
+        if re.match('^[0-9a-f]{40}$', commit):
+            hashes[commit] = commit
+        else:
+            names.append(commit)
+    if not names:
+        return hashes
+
+    try:
+        out = subprocess.check_output(['git', 'rev-parse'] + [name + '^{commit}' for name in names],
+                                      stderr=subprocess.DEVNULL).decode('utf-8')
+        hashes.update(zip(names, out.split()))
+    except subprocess.CalledProcessError:
+        # Some commit is unknown: resolve them one by one.
+        if len(names) > 1:
+            for name in names:
+                hashes.update(resolve_commits([name]))
+    return hashes
+
+#
+# Metrics backends. See Note [Metrics backends].
+#
 
+# Metrics in git notes, one note per commit, in the format of
+# format_perf_stat.
+class GitNotesBackend:
+    def get_perf_stats(self, commits, namespace):
+        return dict((commit, get_note_stats(commit, namespace))
+                    for commit in commits)
+
+    def append_perf_stat(self, stats, commit, namespace, max_tries):
+        print('Appending ' + str(len(stats)) + ' stats to git notes.')
+        stats_str = format_perf_stat(stats)
+        def try_append():
+                try:
+                    return subprocess.check_output(['git', 'notes', '--ref=' + namespace, 'append', commit, '-m', stats_str])
+                except subprocess.CalledProcessError:
+                    return b'Git - fatal'
+
+        tries = 0
+        while tries < max_tries:
+            if not b'Git - fatal' in try_append():
+                return True
+            tries += 1
+            time.sleep(1)
+
+        print("\nAn error occured while writing the performance metrics to git notes.\n \
+	​            This is usually due to a lock-file existing somewhere in the git repo.")
+
+        return False
+
+    # What the registry cache depends on besides the git notes (which it
+    # already depends on).
+    def state(self):
+        return None
+
+# Metrics in an SQLite database, indexed by commit. The values are kept
+# as text, like in git notes.
+class SqliteBackend:
+    schema = """
+        CREATE TABLE IF NOT EXISTS metrics (
+            namespace TEXT NOT NULL,
+            commit_hash TEXT NOT NULL,
+            test_env TEXT NOT NULL,
+            test TEXT NOT NULL,
+            way TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS metrics_key
+            ON metrics (namespace, commit_hash, test_env, test, way, metric);
+        """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connect() as db:
+            db.executescript(self.schema)
+
+    # A connection for a single transaction. Connections are not shared,
+    # as .T files are executed in threads, and tests in forked processes.
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get_perf_stats(self, commits, namespace):
+        hashes = resolve_commits(commits)
+        stats = dict((h, []) for h in hashes.values())
+        with self.connect() as db:
+            unique_hashes = list(stats)
+            # SQLite limits the number of parameters of a query.
+            for i in range(0, len(unique_hashes), 500):
+                chunk = unique_hashes[i:i + 500]
+                rows = db.execute(
+                    'SELECT commit_hash, test_env, test, way, metric, value'
+                    ' FROM metrics WHERE namespace = ? AND commit_hash IN ({0})'
+                    ' ORDER BY rowid'.format(', '.join('?' * len(chunk))),
+                    [namespace] + chunk)
+                for (h, *fields) in rows:
+                    stats[h].append(PerfStat(*fields))
+        return dict((commit, list(stats[hashes[commit]]) if commit in hashes else [])
+                    for commit in commits)
+
+    def append_perf_stat(self, stats, commit, namespace, max_tries):
+        print('Appending ' + str(len(stats)) + ' stats to ' + self.path + '.')
+        hashes = resolve_commits([commit])
+        if commit not in hashes:
+            print('\nUnknown commit ' + commit + ', the performance metrics were not saved.')
+            return False
+        with self.connect() as db:
+            self.insert(db, namespace, hashes[commit], stats)
+        return True
+
+    def insert(self, db, namespace, commit_hash, stats):
+        db.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       [(namespace, commit_hash) + tuple(str(field) for field in stat)
+                        for stat in stats])
+
+    # Replace the metrics of the commits that have git notes with the ones
+    # in the notes. Returns the number of commits.
+    def import_notes(self, namespace='perf'):
+        notes = get_all_note_stats(namespace)
+        with self.connect() as db:
+            for (commit_hash, stats) in notes.items():
+                db.execute('DELETE FROM metrics WHERE namespace = ? AND commit_hash = ?',
+                           (namespace, commit_hash))
+                self.insert(db, namespace, commit_hash, stats)
+        return len(notes)
+
+    # Replace the git notes of the commits in the database with their
+    # metrics. Returns the number of commits.
+    def export_notes(self, namespace='perf'):
+        stats = {}
+        with self.connect() as db:
+            for (commit_hash, *fields) in db.execute(
+                    'SELECT commit_hash, test_env, test, way, metric, value'
+                    ' FROM metrics WHERE namespace = ? ORDER BY rowid', (namespace,)):
+                stats.setdefault(commit_hash, []).append(PerfStat(*fields))
+        for (commit_hash, commit_stats) in stats.items():
+            subprocess.run(['git', 'notes', '--ref=' + namespace, 'add', '-f', '-F', '-', commit_hash],
+                           input=(format_perf_stat(commit_stats) + '\n').encode('utf-8'),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           check=True)
+        return len(stats)
+
+    def state(self):
+        try:
+            st = os.stat(self.path)
+            return (self.path, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return (self.path, None)
+
+# Where the SQLite backend keeps its database by default: in the cache
+# directory of the driver (see --cache-dir).
+default_metrics_db = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  '.driver-cache', 'metrics.sqlite')
+
+# The backend for --metrics-backend: 'git', 'sqlite', or 'sqlite:PATH'.
+def parse_metrics_backend(spec, default_db=default_metrics_db):
+    if spec == 'git':
+        return GitNotesBackend()
+    if spec == 'sqlite':
+        return SqliteBackend(default_db)
+    if spec.startswith('sqlite:'):
+        return SqliteBackend(spec[len('sqlite:'):])
+    raise ValueError('unknown metrics backend: ' + spec)
+
+# Note [Metrics backends]
+#
+# The metrics of the performance tests are kept per commit, in git notes
+# by default (see append_perf_stat). Reading the metrics of a commit from
+# its note takes a git process, so going through the history of many
+# commits is slow.
+#
+# Instead, they can be kept in an SQLite database (--metrics-backend=sqlite
+# for the driver and perf_notes.py), where the metrics of thousands of
+# commits are found with a single query. The database is local: the
+# metrics in git notes (e.g. fetched from CI) are copied into it with
+# `perf_notes.py --backend=sqlite --import-notes`, and the ones in the
+# database written to git notes with --export-notes.
+
+metrics_backend = GitNotesBackend()
+
+def set_metrics_backend(backend):
+    global metrics_backend
+    metrics_backend = backend
+    with baselines_lock:
+        baselines.clear()
 
 # Get allowed changes to performance. This is extracted from the commit message of
 # the given commit in this form:
@@ -192,31 +472,17 @@ def format_perf_stat(stats):
 
     return "\n".join(["\t".join([str(stat_val) for stat_val in stat]) for stat in stats])
 
-# Appends a list of metrics to the git note of the given commit.
+# Appends a list of metrics to the git note of the given commit (or to the
+# metrics backend, see Note [Metrics backends]).
 # Tries up to max_tries times to write to git notes should it fail for some reason.
 # Each retry will wait 1 second.
 # Returns True if the note was successfully appended.
 def append_perf_stat(stats, commit='HEAD', namespace='perf', max_tries=5):
-    # Append to git note
-    print('Appending ' + str(len(stats)) + ' stats to git notes.')
-    stats_str = format_perf_stat(stats)
-    def try_append():
-            try:
-                return subprocess.check_output(['git', 'notes', '--ref=' + namespace, 'append', commit, '-m', stats_str])
-            except subprocess.CalledProcessError:
-                return b'Git - fatal'
-
-    tries = 0
-    while tries < max_tries:
-        if not b'Git - fatal' in try_append():
-            return True
-        tries += 1
-        time.sleep(1)
-
-    print("\nAn error occured while writing the performance metrics to git notes.\n \
-	​            This is usually due to a lock-file existing somewhere in the git repo.")
-
-    return False
+    # See Note [Baselines].
+    with baselines_lock:
+        for key in [key for key in baselines if key[1] == namespace]:
+            del baselines[key]
+    return metrics_backend.append_perf_stat(stats, commit, namespace, max_tries)
 
 # Check test stats. This prints the results for the user.
 # actual: the PerfStat with actual value.
@@ -285,10 +551,31 @@ if __name__ == '__main__':
     parser.add_argument("--add-note", nargs=3,
                         help="Development only. --add-note N commit seed \
                         Adds N fake metrics to the given commit using the random seed.")
+    parser.add_argument("--backend", default='git',
+                        help="Where the metrics are: 'git' (git notes, the default), \
+                        'sqlite' or 'sqlite:PATH'. See Note [Metrics backends].")
+    parser.add_argument("--import-notes", action="store_true",
+                        help="Copy the metrics in all git notes into the sqlite backend.")
+    parser.add_argument("--export-notes", action="store_true",
+                        help="Write the metrics in the sqlite backend to git notes.")
     parser.add_argument("commits", nargs=argparse.REMAINDER,
                         help="The rest of the arguments will be the commits that will be used.")
     args = parser.parse_args()
 
+    try:
+        set_metrics_backend(parse_metrics_backend(args.backend))
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.import_notes or args.export_notes:
+        if not isinstance(metrics_backend, SqliteBackend):
+            parser.error('--import-notes and --export-notes need the sqlite backend')
+        if args.import_notes:
+            print('Imported the notes of ' + str(metrics_backend.import_notes()) + ' commits.')
+        if args.export_notes:
+            print('Exported the metrics of ' + str(metrics_backend.export_notes()) + ' commits.')
+        exit(0)
+
     env = 'local'
     name = re.compile('.*')
     # metrics is a tuple (str commit, PerfStat stat)
@@ -301,8 +588,9 @@ if __name__ == '__main__':
     #
 
     if args.commits:
+        stats_of = get_perf_stats_of(args.commits)
         for c in args.commits:
-            metrics += [CommitAndStat(c, stat) for stat in get_perf_stats(c)]
+            metrics += [CommitAndStat(c, stat) for stat in stats_of[c]]
 
     if args.test_env:
         metrics = [test for test in metrics if test.stat.test_env == args.test_env]
@@ -350,6 +638,11 @@ if __name__ == '__main__':
         print(second_line)
         print("-" * (len(second_line)+1))
 
+    # The values of the metrics of every test in every commit.
+    values_of = {}
+    for t in metrics:
+        values_of.setdefault((t.commit, t.stat.test), []).append(float(t.stat.value))
+
     def commit_string(test, flag):
         def delta(v1, v2):
             return round((100 * (v1 - v2)/v2),2)
@@ -358,7 +651,7 @@ if __name__ == '__main__':
         # Note: if the test environment is not set, this will combine metrics from all test environments.
         averageValuesOrNones = []
         for commit in args.commits:
-            values = [float(t.stat.value) for t in metrics if t.commit == commit and t.stat.test == test]
+            values = values_of.get((commit, test), [])
             if values == []:
                 averageValuesOrNones.append(None)
             else:
@@ -0,0 +1,221 @@
+#
+# A cache of the tests registered by each .T file, so that the driver
+# doesn't have to execute the .T files (and the setup functions of every
+# test) again when they haven't changed. See Note [Registry cache] in
+# runtests.py.
+#
+
+import hashlib
+import importlib
+import io
+import marshal
+import os
+import pickle
+import subprocess
+import sys
+import types
+
+from result_cache import hash_file, hash_value
+
+# The pickler needs Pickler.reducer_override and types.CellType, which
+# are new in Python 3.8.
+supported = sys.version_info >= (3, 8)
+
+# Tests are pickled with their options, which contain functions: lambdas
+# and functions defined in .T files, and the lambdas that setup functions
+# compose (e.g. extra_normaliser). None of those can be pickled by
+# reference, so they are pickled by value: their code, defaults and
+# closure, and their globals. Every .T file is executed with its own
+# globals (see Note [Loading .T files] in testlib.py), of which only the
+# ones that the .T file defined are pickled.
+#
+# Objects that are there before any .T file is executed, such as config
+# and the functions of testlib, are pickled by reference to their name
+# instead, so that the tests refer to the objects of the current run.
+
+# Values that are the same however they are pickled.
+_plain_types = (int, float, complex, str, bytes, bool, type(None), tuple,
+                frozenset)
+
+class _Empty:
+    pass
+
+# Stands for the globals of the .T file while pickling.
+class _FileGlobals:
+    def __init__(self, values):
+        self.values = values
+
+def _make_globals():
+    return dict(sys.modules['__main__'].__dict__)
+
+def _set_globals(globals, values):
+    globals.update(values)
+    return globals
+
+def _make_function(code, globals, name, n_cells):
+    if isinstance(globals, str):
+        globals = importlib.import_module(globals).__dict__
+    closure = tuple(types.CellType() for _ in range(n_cells)) or None
+    return types.FunctionType(marshal.loads(code), globals, name, None, closure)
+
+def _set_function_state(f, state):
+    (qualname, defaults, kwdefaults, cells, attributes) = state
+    f.__qualname__ = qualname
+    f.__defaults__ = defaults
+    f.__kwdefaults__ = kwdefaults
+    for (cell, value) in zip(f.__closure__ or (), cells):
+        if not isinstance(value, _Empty):
+            cell.cell_contents = value
+    f.__dict__.update(attributes)
+    return f
+
+def _is_by_reference(f):
+    if f.__module__ == '__main__' or f.__module__ not in sys.modules:
+        return False
+    obj = sys.modules[f.__module__]
+    for part in f.__qualname__.split('.'):
+        obj = getattr(obj, part, None)
+    return obj is f
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, shared, file_globals):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared_ids = {id(value): name for (name, value) in shared.items()
+                               if not isinstance(value, _plain_types)}
+        self.file_globals = file_globals
+        self.file_globals_token = _FileGlobals(
+            {name: value for (name, value) in file_globals.items()
+                         if not (name in shared and shared[name] is value)})
+
+    def persistent_id(self, obj):
+        if isinstance(obj, _plain_types):
+            return None
+        return self.shared_ids.get(id(obj))
+
+    def reducer_override(self, obj):
+        if isinstance(obj, types.ModuleType):
+            return (importlib.import_module, (obj.__name__,))
+        if isinstance(obj, _FileGlobals):
+            # The globals are created before their values are set, as
+            # these refer back to the globals.
+            return (_make_globals, (), obj.values, None, None, _set_globals)
+        if not isinstance(obj, types.FunctionType) or _is_by_reference(obj):
+            return NotImplemented
+
+        if obj.__globals__ is self.file_globals:
+            globals = self.file_globals_token
+        else:
+            # Otherwise, only lambdas of driver modules can be pickled.
+            globals = obj.__globals__.get('__name__')
+            if globals == '__main__' or sys.modules.get(globals) is None \
+               or sys.modules[globals].__dict__ is not obj.__globals__:
+                raise pickle.PicklingError(
+                          'cannot pickle function {0}'.format(obj.__qualname__))
+
+        cells = []
+        for cell in obj.__closure__ or ():
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                cells.append(_Empty())
+        state = (obj.__qualname__, obj.__defaults__, obj.__kwdefaults__,
+                 cells, obj.__dict__)
+        return (_make_function,
+                (marshal.dumps(obj.__code__), globals, obj.__name__, len(cells)),
+                state, None, None, _set_function_state)
+
+    def dump_registration(self, registration):
+        # Pickle the globals first, see _FileGlobals.
+        self.dump((self.file_globals_token, registration))
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, shared):
+        super().__init__(file)
+        self.shared = shared
+
+    def persistent_load(self, pid):
+        return self.shared[pid]
+
+# The state of the git repository that setup functions depend on: the
+# HEAD commit, and the performance metrics in git notes (see
+# collect_stats).
+def git_state():
+    try:
+        return subprocess.check_output(
+                   ['git', 'for-each-ref', '--format=%(refname) %(objectname)',
+                    'refs/notes'],
+                   stderr=subprocess.DEVNULL, universal_newlines=True) \
+             + subprocess.check_output(
+                   ['git', 'rev-parse', 'HEAD'],
+                   stderr=subprocess.DEVNULL, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+# Hash everything besides the .T files that the tests registered by them
+# depend on: the fields of the configuration (except the given ones),
+# the driver, the version of Python (which marshals the code of
+# functions), and anything else given.
+def fingerprint(config, ignored_fields, *others):
+    driver_dir = os.path.dirname(os.path.abspath(__file__))
+    return hash_value([
+        {field: value for (field, value) in vars(config).items()
+                      if field not in ignored_fields},
+        [(f, hash_file(os.path.join(driver_dir, f)))
+         for f in sorted(os.listdir(driver_dir)) if f.endswith('.py')],
+        sys.version,
+        os.getcwd(),
+        git_state(),
+        list(others),
+    ])
+
+class RegistryCache:
+    # shared: the objects to pickle by reference, by name. fingerprint: a
+    # hash of everything besides the .T files that the registered tests
+    # depend on.
+    def __init__(self, directory, shared, fingerprint):
+        self.directory = directory
+        self.shared = shared
+        self.fingerprint = fingerprint
+
+    def _path(self, t_file):
+        key = hashlib.sha256(os.path.abspath(t_file).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, key + '.pickle')
+
+    # What the .T file registered when it was stored, or None if the .T
+    # file or the fingerprint changed since then.
+    def load(self, t_file):
+        try:
+            with open(self._path(t_file), 'rb') as f:
+                (fingerprint, stat, file_hash, data) = pickle.load(f)
+            if fingerprint != self.fingerprint:
+                return None
+            st = os.stat(t_file)
+            if (st.st_mtime_ns, st.st_size) != stat \
+               and hash_file(t_file) != file_hash:
+                return None
+            (_, registration) = _Unpickler(io.BytesIO(data), self.shared).load()
+            return registration
+        except Exception:
+            # Anything could go wrong with a stale or broken cache entry:
+            # execute the .T file instead.
+            return None
+
+    # Store what the .T file registered, given its stat (from before it
+    # was read), its contents, and the globals it was executed with.
+    # Returns False if it can't be pickled.
+    def store(self, t_file, st, src, file_globals, registration):
+        try:
+            data = io.BytesIO()
+            _Pickler(data, self.shared, file_globals).dump_registration(registration)
+        except (pickle.PicklingError, TypeError, AttributeError, ValueError):
+            return False
+
+        entry = (self.fingerprint, (st.st_mtime_ns, st.st_size),
+                 hashlib.sha256(src).hexdigest(), data.getvalue())
+        path = self._path(t_file)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return True
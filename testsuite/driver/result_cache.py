@@ -0,0 +1,196 @@
+#
+# A cache of the results of test cases, by a hash of everything that can
+# affect them. See Note [Result cache] in testlib.py.
+#
+
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+import types
+
+from normaliser import Normaliser, Rule
+
+# Hash a value, including the code of functions in it, and the values
+# they close over. Values we don't know how to hash stably (e.g. objects
+# whose repr contains their address) give a different hash every run, so
+# they can only cause cache misses.
+def hash_value(value):
+    h = hashlib.sha256()
+    _hash_value(h, value, set())
+    return h.hexdigest()
+
+def _hash_value(h, value, seen):
+    def update(tag, s):
+        h.update('{0}:{1}:'.format(tag, len(s)).encode('utf8'))
+        h.update(s)
+
+    if isinstance(value, (types.FunctionType, types.MethodType)) \
+       or isinstance(value, (dict, list, tuple, set, frozenset)):
+        # Guard against cycles.
+        if id(value) in seen:
+            update('seen', b'')
+            return
+        seen = seen | {id(value)}
+
+    if isinstance(value, types.MethodType):
+        update('method', value.__name__.encode('utf8'))
+        _hash_value(h, value.__func__, seen)
+        _hash_value(h, value.__self__, seen)
+    elif isinstance(value, types.FunctionType):
+        update('function', value.__name__.encode('utf8'))
+        _hash_value(h, value.__code__, seen)
+        _hash_value(h, value.__defaults__, seen)
+        cells = []
+        for cell in value.__closure__ or []:
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                # An empty cell.
+                cells.append(None)
+        _hash_value(h, cells, seen)
+    elif isinstance(value, types.CodeType):
+        update('code', value.co_code)
+        _hash_value(h, value.co_consts, seen)
+        _hash_value(h, value.co_names, seen)
+    elif isinstance(value, dict):
+        update('dict', str(len(value)).encode('utf8'))
+        for key in sorted(value, key=repr):
+            _hash_value(h, key, seen)
+            _hash_value(h, value[key], seen)
+    elif isinstance(value, (list, tuple)):
+        update(type(value).__name__, str(len(value)).encode('utf8'))
+        for x in value:
+            _hash_value(h, x, seen)
+    elif isinstance(value, (set, frozenset)):
+        update('set', str(len(value)).encode('utf8'))
+        for x in sorted(value, key=repr):
+            _hash_value(h, x, seen)
+    elif isinstance(value, bytes):
+        update('bytes', value)
+    elif isinstance(value, Normaliser):
+        update('normaliser', b'')
+        _hash_value(h, value.steps, seen)
+    elif isinstance(value, Rule):
+        update('rule', b'')
+        _hash_value(h, [value.pattern, value.replacement, value.needle], seen)
+    else:
+        update(type(value).__name__, repr(value).encode('utf8'))
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Hash the contents of a file, or of all files in a directory.
+def hash_path(path):
+    if os.path.isdir(path):
+        hashes = []
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                hashes.append((os.path.relpath(file_path, path),
+                               hash_file(file_path)))
+        return hash_value(hashes)
+    elif os.path.exists(path):
+        return hash_file(path)
+    else:
+        return None
+
+# Hash the names, sizes and modification times of the files in a
+# directory. Cheaper than hash_path for big directories, such as the
+# libdir of the compiler.
+def hash_tree_stat(path):
+    stats = []
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            stats.append((os.path.relpath(file_path, path),
+                          st.st_size, st.st_mtime_ns))
+    return hash_value(stats)
+
+# The fields of the package descriptions in a package database with the
+# directories of their libraries and interface files.
+package_dir_fields = ['import-dirs', 'library-dirs', 'dynamic-library-dirs']
+
+# The directories of the libraries and interface files of the packages in
+# a package database (a directory of .conf files), besides those in the
+# libdir. With a dynamically linked compiler, the shared libraries it
+# loads (those of the ghc package, say) are in these too.
+def package_dirs(package_db, libdir):
+    dirs = set()
+    for conf in glob.glob(os.path.join(package_db, '*.conf')):
+        try:
+            with open(conf, encoding='utf8', errors='replace') as f:
+                text = f.read()
+        except IOError:
+            continue
+        # A field goes on on the lines that start with whitespace.
+        for m in re.finditer(r'^([\w-]+):(.*(?:\n[ \t].*)*)', text, re.MULTILINE):
+            if m.group(1) in package_dir_fields:
+                for path in m.group(2).split():
+                    path = path.strip('"') \
+                               .replace('${pkgroot}', os.path.dirname(package_db)) \
+                               .replace('$topdir', libdir)
+                    dirs.add(os.path.normpath(path))
+    # Leave out the directories inside others, and inside the libdir.
+    roots = [os.path.normpath(libdir)]
+    for path in sorted(dirs):
+        if not any(path == root or path.startswith(root + os.sep)
+                   for root in roots):
+            roots.append(path)
+    return roots[1:]
+
+# Hash everything that can affect all test results: the compiler (and
+# everything in its libdir, and in the directories of the packages in its
+# package database), its `--info`, the driver, and the makefiles of the
+# testsuite.
+def run_fingerprint(compiler, compiler_info, libdir, package_db, top):
+    driver_dir = os.path.dirname(os.path.abspath(__file__))
+    return hash_value([
+        hash_path(compiler) if os.path.exists(compiler) else compiler,
+        compiler_info,
+        hash_tree_stat(libdir),
+        [(path, hash_tree_stat(path))
+         for path in (package_dirs(package_db, libdir) if package_db else [])],
+        [(f, hash_file(f))
+         for f in sorted(glob.glob(os.path.join(driver_dir, '*.py')))],
+        [(f, hash_file(f))
+         for f in sorted(glob.glob(os.path.join(top, 'mk', '*.mk')))],
+    ])
+
+class ResultCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    # The cached result for the key, or None.
+    def lookup(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def store(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Other threads or processes may store the same key at the same
+        # time.
+        tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                            threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
@@ -5,7 +5,10 @@
 #
 
 import argparse
+import collections
+import concurrent.futures
 import signal
+import sqlite3
 import sys
 import os
 import io
@@ -23,11 +26,16 @@ import traceback
 # So we import it here first, so that the testsuite doesn't appear to fail.
 import subprocess
 
-from testutil import getStdout, Watcher, str_warn, str_info
-from testglobals import getConfig, ghc_env, getTestRun, TestOptions, brokens
-from perf_notes import MetricChange, inside_git_repo, is_worktree_dirty
+from testutil import getStdout, Watcher, str_warn, str_info, physical_memory, ram_backed_dir
+from testglobals import getConfig, ghc_env, getTestRun, TestOptions, brokens, save_test_run, load_test_run
+from perf_notes import MetricChange, inside_git_repo, is_worktree_dirty, parse_metrics_backend, set_metrics_backend
 from junit import junit
 import cpu_features
+import timings
+import since
+from testindex import TestIndex
+from registry_cache import RegistryCache, fingerprint as registry_fingerprint, \
+                           supported as registry_cache_supported
 
 # Readline sometimes spews out ANSI escapes for some values of TERM,
 # which result in test failures. Thus set TERM to a nice, simple, safe
@@ -44,6 +52,18 @@ def signal_handler(signal, frame):
 # -----------------------------------------------------------------------------
 # cmd-line options
 
+def parse_shard(s):
+    m = re.match('^([0-9]+)/([0-9]+)$', s)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError('expected I/N with 1 <= I <= N, not ' + s)
+    return (int(m.group(1)), int(m.group(2)))
+
+def parse_size(s):
+    m = re.match('^([0-9]+)([KMG]?)$', s.upper())
+    if not m:
+        raise argparse.ArgumentTypeError('expected a number of bytes, optionally followed by K, M or G, not ' + s)
+    return int(m.group(1)) * 1024 ** ' KMG'.index(m.group(2) or ' ')
+
 parser = argparse.ArgumentParser(description="GHC's testsuite driver")
 perf_group = parser.add_mutually_exclusive_group()
 
@@ -51,16 +71,34 @@ parser.add_argument("-e", action='append', help="A string to execute from the co
 parser.add_argument("--config-file", action="append", help="config file")
 parser.add_argument("--config", action='append', help="config field")
 parser.add_argument("--rootdir", action='append', help="root of tree containing tests (default: .)")
-parser.add_argument("--metrics-file", help="file in which to save (append) the performance test metrics. If omitted, git notes will be used.")
+parser.add_argument("--metrics-file", help="file in which to save (append) the performance test metrics. If omitted, the metrics backend (git notes by default) will be used.")
+parser.add_argument("--metrics-backend", metavar="BACKEND", help="where to keep the performance test metrics of every commit: 'git' (git notes, the default), 'sqlite' (a database in the cache directory) or 'sqlite:PATH', see Note [Metrics backends] in perf_notes.py")
 parser.add_argument("--summary-file", help="file in which to save the (human-readable) summary")
+parser.add_argument("--cache-dir", help="directory in which to keep data between test runs, such as test durations (default: <top>/.driver-cache)")
 parser.add_argument("--no-print-summary", action="store_true", help="should we print the summary?")
 parser.add_argument("--only", action="append", help="just this test (can be give multiple --only= flags)")
+parser.add_argument("--since", metavar="REV", help="just the tests that changes since this git revision could affect, see Note [Selecting tests with --since]")
 parser.add_argument("--way", action="append", help="just this way")
 parser.add_argument("--skipway", action="append", help="skip this way")
 parser.add_argument("--threads", type=int, help="threads to run simultaneously")
+parser.add_argument("--jobserver", action="store_true", help="let the commands of the tests (such as make) run their jobs in the --threads CPU slots of the driver, see Note [Jobserver] in testlib.py")
+parser.add_argument("--memory-budget", type=int, metavar="MB", help="how much memory (in MB) the tests that declare their memory use may use at the same time (default: half of the physical memory)")
+parser.add_argument("--executor", choices=['thread', 'process'], help="run parallel tests in threads (default) or in a pool of worker processes")
+parser.add_argument("--output-limit", type=int, metavar="BYTES", help="keep at most this much of the output of every command (default: all of it)")
+parser.add_argument("--diff-limit", type=int, metavar="LINES", help="show at most this many lines of the diff of every output that differs from the expected one (default: all of them)")
+parser.add_argument("--result-cache", action="store_true", help="don't run test cases that were run before with the same compiler, options and files, but replay their results")
+parser.add_argument("--registry-cache", action="store_true", help="load the tests of .T files that didn't change from a cache, instead of executing the .T files, see Note [Registry cache]")
+parser.add_argument("--no-background-cleanup", action="store_true", help="remove test directories right away, instead of in the background, see Note [Background cleanup] in testlib.py")
+parser.add_argument("--sandbox-pool", type=int, metavar="N", help="keep up to N emptied test directories per directory of tests, to reuse for new test directories (default: 0)")
+parser.add_argument("--workdir-tmpfs", type=parse_size, metavar="SIZE", help="put test directories in a RAM-backed directory such as /dev/shm, as long as they take up at most SIZE bytes (with suffix K, M or G) together, see Note [RAM-backed test directories] in testlib.py")
 parser.add_argument("--verbose", type=int, choices=[0,1,2,3,4,5], help="verbose (Values 0 through 5 accepted)")
 parser.add_argument("--junit", type=argparse.FileType('wb'), help="output testsuite summary in JUnit format")
 parser.add_argument("--test-env", default='local', help="Override default chosen test-env.")
+parser.add_argument("--shard", type=parse_shard, metavar="I/N", help="only run the I-th (from 1) of N shards of the tests, see Note [Sharding]")
+parser.add_argument("--shard-durations", help="file with the test durations by which to balance shards (default: assign tests to shards by a hash of their names, which gives shards of roughly the same number of tests)")
+parser.add_argument("--results-file", help="file in which to save the results, for --merge-results")
+parser.add_argument("--merge-results", nargs='+', metavar="FILE", help="don't run any tests, but combine the results saved with --results-file into one summary")
+parser.add_argument("--timing-report", type=int, nargs='?', const=20, metavar="N", help="don't run any tests, but list the N (default: 20) directories and ways that took the most CPU time in previous test runs, see Note [Phase timings] in testlib.py")
 perf_group.add_argument("--skip-perf-tests", action="store_true", help="skip performance tests")
 perf_group.add_argument("--only-perf-tests", action="store_true", help="Only do performance tests")
 
@@ -88,6 +126,16 @@ config.metrics_file = args.metrics_file
 hasMetricsFile = bool(config.metrics_file)
 config.summary_file = args.summary_file
 config.no_print_summary = args.no_print_summary
+config.cache_dir = args.cache_dir or os.path.join(config.top, '.driver-cache')
+
+if args.metrics_backend:
+    config.metrics_backend = args.metrics_backend
+try:
+    set_metrics_backend(parse_metrics_backend(
+        config.metrics_backend, os.path.join(config.cache_dir, 'metrics.sqlite')))
+except (ValueError, sqlite3.Error) as e:
+    print(str(e))
+    sys.exit(2)
 
 if args.only:
     config.only = args.only
@@ -116,6 +164,36 @@ if args.threads:
     config.threads = args.threads
     config.use_threads = True
 
+if args.executor:
+    config.executor = args.executor
+
+if args.output_limit is not None:
+    config.output_limit = args.output_limit
+
+if args.diff_limit is not None:
+    config.diff_limit = args.diff_limit
+
+if args.result_cache:
+    config.result_cache = True
+
+if args.no_background_cleanup:
+    config.background_cleanup = False
+if args.sandbox_pool is not None:
+    config.sandbox_pool = args.sandbox_pool
+if args.jobserver:
+    config.jobserver = True
+if args.workdir_tmpfs is not None:
+    config.workdir_tmpfs = args.workdir_tmpfs
+if args.registry_cache:
+    config.registry_cache = True
+
+# See Note [Test resources] in testlib.py.
+if args.memory_budget:
+    config.memory_budget = args.memory_budget
+elif not config.memory_budget:
+    memory = physical_memory()
+    config.memory_budget = memory // 2 if memory else config.high_memory_usage
+
 if args.verbose is not None:
     config.verbose = args.verbose
 
@@ -130,6 +208,37 @@ config.only_perf_tests = args.only_perf_tests
 if args.test_env:
     config.test_env = args.test_env
 
+if args.merge_results:
+    # See Note [Sharding].
+    from testlib import summary
+    t = getTestRun()
+    runs = [load_test_run(f) for f in args.merge_results]
+    for run in runs:
+        t.merge(run)
+    t.start_time = min(runs, key=lambda run: time.mktime(run.start_time)).start_time
+    t.end_time = max(run.end_time for run in runs)
+
+    summary(t, sys.stdout, config.no_print_summary, True)
+    if config.summary_file:
+        with open(config.summary_file, 'w') as file:
+            summary(t, file)
+    if args.junit:
+        junit(t).write(args.junit)
+    timings.save_durations(os.path.join(config.cache_dir, 'durations.json'),
+                           t.durations)
+    timings.save_phase_times(os.path.join(config.cache_dir, 'phases.json'),
+                             t.phase_times)
+    timings.save_sandbox_sizes(os.path.join(config.cache_dir, 'sandbox_sizes.json'),
+                               t.sandbox_sizes)
+
+    exit(1 if t.unexpected_failures or t.unexpected_stat_failures
+              or t.framework_failures else 0)
+
+if args.timing_report is not None:
+    timings.report(timings.load_phase_times(os.path.join(config.cache_dir, 'phases.json')),
+                   sys.stdout, args.timing_report)
+    exit(0)
+
 config.cygwin = False
 config.msys = False
 
@@ -146,6 +255,16 @@ if windows:
     else:
         raise Exception("Can't detect Windows terminal type")
 
+    if config.executor == 'process':
+        # The process executor relies on fork. See Note [Process executor].
+        print('WARNING: --executor=process is not supported on Windows, using threads.')
+        config.executor = 'thread'
+    # Directories can't be renamed while something has a file in them
+    # open, see cleanup in testlib.py.
+    config.background_cleanup = False
+    # Needs pipes that commands can inherit. See Note [Jobserver].
+    config.jobserver = False
+
 # Try to use UTF8
 if windows:
     import ctypes
@@ -268,6 +387,31 @@ t_files = list(findTFiles(config.rootdirs))
 
 print('Found', len(t_files), '.T files...')
 
+if args.since:
+    try:
+        root = since.repo_root()
+        changed = since.changed_files(args.since, root)
+    except subprocess.CalledProcessError:
+        print('Failed to find the files changed since', args.since)
+        sys.exit(2)
+    (t_files, changed_everything) = \
+        since.select_t_files(t_files, changed, root,
+                             config.since_dependents, config.since_ignore)
+    if changed_everything:
+        print('Not selecting tests: {0} may affect any test'.format(changed_everything))
+    else:
+        print('Selected', len(t_files), '.T files affected by the',
+              len(changed), 'files changed since', args.since)
+
+# See Note [Test index].
+if config.run_only_some_tests:
+    test_index = TestIndex(os.path.join(config.cache_dir, 'test_index.json'))
+    only_t_files = test_index.select(t_files, config.only)
+    test_index.save()
+    if len(only_t_files) < len(t_files):
+        print('Selected', len(only_t_files), '.T files defining the tests given with --only')
+        t_files = only_t_files
+
 t = getTestRun()
 
 # Avoid cmd.exe built-in 'date' command on Windows
@@ -301,25 +445,115 @@ else:
     # tempdir.
     tempdir = os.path.join(tempdir, 'test   spaces')
 
+# See Note [RAM-backed test directories] in testlib.py.
+ram_tempdir = None
+if config.workdir_tmpfs:
+    ram_dir = ram_backed_dir()
+    if config.local:
+        print(str_warn('--workdir-tmpfs is ignored with LOCAL=1.'))
+    elif ram_dir is None:
+        print(str_warn('--workdir-tmpfs: no RAM-backed directory found, keeping test directories on disk.'))
+    else:
+        ram_tempdir = tempfile.mkdtemp('', 'ghctest-', ram_dir)
+        st = os.statvfs(ram_tempdir)
+        budget = min(config.workdir_tmpfs, st.f_bavail * st.f_frsize)
+        memory = physical_memory()
+        setupWorkArea(tempdir, ram_tempdir, budget,
+                      memory // 16 if memory else 0,
+                      timings.load_sandbox_sizes(
+                          os.path.join(config.cache_dir, 'sandbox_sizes.json')))
+
 def cleanup_and_exit(exitcode):
+    finishBackgroundCleanup()
     if config.cleanup and tempdir:
         shutil.rmtree(tempdir, ignore_errors=True)
+    if config.cleanup and ram_tempdir:
+        shutil.rmtree(ram_tempdir, ignore_errors=True)
     exit(exitcode)
 
-# First collect all the tests to be run
-t_files_ok = True
-for file in t_files:
+# The fields of config that don't affect which tests the .T files
+# register, or their options. See Note [Registry cache].
+registry_ignored_fields = ['only', 'run_only_some_tests', 'verbose',
+    'summary_file', 'metrics_file', 'no_print_summary', 'threads',
+    'use_threads', 'executor', 'memory_budget', 'output_limit',
+    'diff_limit', 'result_cache', 'registry_cache', 'cache_dir', 'accept',
+    'accept_platform', 'accept_os', 'rootdirs', 'background_cleanup',
+    'sandbox_pool', 'workdir_tmpfs', 'jobserver']
+
+# The globals that every .T file starts with. See Note [Loading .T files]
+# in testlib.py.
+t_file_globals = dict(globals())
+
+if config.registry_cache and not registry_cache_supported:
+    print('WARNING: --registry-cache needs Python 3.8 or later, executing all .T files.')
+    config.registry_cache = False
+
+if config.registry_cache:
+    registry_shared = dict(t_file_globals)
+    registry_shared.update(('config.' + field, value)
+                           for (field, value) in vars(config).items())
+    registry = RegistryCache(os.path.join(config.cache_dir, 'registry'),
+                             registry_shared,
+                             registry_fingerprint(config, registry_ignored_fields,
+                                                  get_package_cache_timestamp(),
+                                                  Perf.metrics_backend.state()))
+else:
+    registry = None
+
+# Execute a .T file (or load what it registered from the registry cache).
+# Returns its registration, and whether it could be executed.
+def load_t_file(file):
     if_verbose(2, '====> Scanning %s' % file)
-    newTestDir(tempdir, os.path.dirname(file))
+    registration = newTestDir(tempdir, os.path.dirname(file))
+
+    cached = registry.load(file) if registry else None
+    if cached is not None:
+        (registration.tests, registration.broken) = cached
+        return (registration, True)
+
+    file_globals = dict(t_file_globals)
     try:
-        with io.open(file, encoding='utf8') as f:
+        st = os.stat(file)
+        with io.open(file, 'rb') as f:
             src = f.read()
 
-        exec(src)
+        exec(src.decode('utf8'), file_globals)
     except Exception as e:
         traceback.print_exc()
         framework_fail(file, '', str(e))
-        t_files_ok = False
+        return (registration, False)
+
+    # Only store complete registrations, and let the tests of .T files
+    # with problems report them again in the next run.
+    if registry and not config.run_only_some_tests and not registration.problems:
+        registry.store(file, st, src, file_globals,
+                       (registration.tests, registration.broken))
+    return (registration, True)
+
+# Execute the .T files of one directory, in a thread of the pool.
+def load_t_files(files):
+    setLocalTestOpts(TestOptions())
+    try:
+        return [load_t_file(file) for file in files]
+    finally:
+        tfile_local.registration = None
+
+# First collect all the tests to be run. See Note [Loading .T files] in
+# testlib.py.
+t_files_by_dir = collections.OrderedDict()
+for file in t_files:
+    t_files_by_dir.setdefault(os.path.dirname(file), []).append(file)
+
+if config.use_threads:
+    with concurrent.futures.ThreadPoolExecutor(config.threads) as pool:
+        loaded = list(pool.map(load_t_files, t_files_by_dir.values()))
+else:
+    loaded = [load_t_files(files) for files in t_files_by_dir.values()]
+
+t_files_ok = True
+for (registration, ok) in (x for dir_loaded in loaded for x in dir_loaded):
+    registerTFile(registration)
+    t_files_ok = t_files_ok and ok
 
 for name in config.only:
     if t_files_ok:
@@ -341,28 +575,50 @@ if config.list_broken:
         print('WARNING:', len(t.framework_failures), 'framework failures!')
         print('')
 else:
+    if args.shard:
+        # See Note [Sharding].
+        (shard, shards) = args.shard
+        shard_durations = timings.load_durations(args.shard_durations) \
+                              if args.shard_durations else {}
+        in_shard = set(test.name for test in
+                           timings.shard(parallelTests + aloneTests, shard - 1,
+                                         shards, shard_durations))
+        print('Running shard {0}/{1}: {2} of {3} tests'.format(
+                  shard, shards, len(in_shard),
+                  len(parallelTests) + len(aloneTests)))
+        parallelTests = [test for test in parallelTests if test.name in in_shard]
+        aloneTests = [test for test in aloneTests if test.name in in_shard]
+
+    if config.result_cache and not config.accept:
+        # See Note [Result cache] in testlib.py.
+        initResultCache()
+
+    # See Note [Longest tests first].
+    durations_file = os.path.join(config.cache_dir, 'durations.json')
+    parallelTests = timings.longest_first(parallelTests,
+                                          timings.load_durations(durations_file))
+
+    # See Note [Test cases] in testlib.py.
+    testCases = [case for test in aloneTests + parallelTests
+                      for case in test.cases()]
+
     # completion watcher
-    watcher = Watcher(len(parallelTests))
+    watcher = Watcher(len(testCases))
 
-    # Now run all the tests
+    # Now run all the tests. The tests that must run alone go first, see
+    # Note [Test resources] in testlib.py.
     try:
-        for oneTest in parallelTests:
+        for testCase in testCases:
             if stopping():
                 break
-            oneTest(watcher)
+            testCase(watcher)
 
-        # wait for parallel tests to finish
+        # wait for the tests to finish
         if not stopping():
             watcher.wait()
-
-        # Run the following tests purely sequential
-        config.use_threads = False
-        for oneTest in aloneTests:
-            if stopping():
-                break
-            oneTest(watcher)
+        stopProcessPool()
     except KeyboardInterrupt:
-        pass
+        stopCommands()
 
     # flush everything before we continue
     sys.stdout.flush()
@@ -411,6 +667,15 @@ else:
         else:
             Perf.append_perf_stat(stats)
 
+    if t.durations:
+        timings.save_durations(durations_file, t.durations)
+    if t.phase_times:
+        timings.save_phase_times(os.path.join(config.cache_dir, 'phases.json'),
+                                 t.phase_times)
+    if t.sandbox_sizes:
+        timings.save_sandbox_sizes(os.path.join(config.cache_dir, 'sandbox_sizes.json'),
+                                   t.sandbox_sizes)
+
     # Write summary
     if config.summary_file:
         with open(config.summary_file, 'w') as file:
@@ -419,6 +684,9 @@ else:
     if args.junit:
         junit(t).write(args.junit)
 
+    if args.results_file:
+        save_test_run(t, args.results_file)
+
 if len(t.unexpected_failures) > 0 or \
    len(t.unexpected_stat_failures) > 0 or \
    len(t.framework_failures) > 0:
@@ -459,3 +727,110 @@ cleanup_and_exit(exitcode)
 #
 # [1]
 # https://downloads.haskell.org/~ghc/8.0.1/docs/html/users_guide/separate_compilation.html#output-files
+
+# Note [Longest tests first]
+#
+# The parallel tests are started in order of decreasing duration, as
+# recorded in the previous runs (a longest-processing-time-first
+# schedule). All the ways of a test are started one after the other, see
+# Note [Test cases] in testlib.py. Starting a few tests that take minutes near the end of the
+# run would otherwise keep one thread busy long after all the others have
+# run out of work.
+#
+# The durations are saved in <cache_dir>/durations.json at the end of
+# every run. Tests without a recorded duration, such as new tests, are
+# started first.
+
+# Note [Sharding]
+#
+# A test run can be split over several machines with --shard=I/N: every
+# machine collects all the tests, and then only runs the tests of the
+# I-th shard. The shards are balanced by the durations in the file given
+# with --shard-durations. Tests without a duration (all of them, without
+# the file) are assigned to a shard by a hash of their name, which only
+# gives roughly the same number of tests per shard. The assignment of
+# tests to shards is deterministic, so to make sure that every test is
+# run on exactly one machine, give every machine the same durations file
+# (e.g. the durations.json in the cache directory of the machine that
+# merges the results, see below).
+#
+# Each shard saves its results with --results-file, and
+#
+#     runtests.py --merge-results shard1.json shard2.json ... \
+#                 [--junit FILE] [--summary-file FILE]
+#
+# combines them into one summary and one JUnit report, and adds the
+# durations of the tests of all the shards to its durations.json.
+
+# Note [Selecting tests with --since]
+#
+# With --since=REV, the driver only runs the tests that the changes since
+# the git revision REV (including changes in the working tree that are not
+# committed yet) could affect, for example
+#
+#     make test EXTRA_RUNTEST_OPTS=--since=origin/master
+#
+# It selects .T files, and then runs their tests as usual (so --only and
+# --way still apply):
+#
+#  * A changed file in a test directory (a .T file, or a source or expected
+#    output file of a test) selects the .T files of its directory, or of
+#    the nearest directory above it that contains .T files.
+#
+#  * A changed file in one of the paths in config.since_dependents, such
+#    as a tool in utils/, selects all .T files below the test directories
+#    declared as its dependents, see testsuite/config/ghc.
+#
+#  * Changed files in config.since_ignore, such as documentation, select
+#    nothing.
+#
+#  * Any other changed file (e.g. in compiler/, rts/, base, or the driver
+#    itself) could affect any test, so it selects all of them.
+#
+# This is a heuristic: a test that uses files from another directory
+# (e.g. through extra_files) is not selected by changes to those files.
+# It speeds up checks before pushing, but doesn't replace a full validate.
+
+# Note [Registry cache]
+#
+# Executing the .T files is a big part of the startup time of the
+# driver, especially when running only a few tests: the setup functions
+# of some tests run git (collect_stats) or ghc-pkg (reqlib).
+#
+# So the tests that each .T file registers (their names, options, test
+# functions and arguments, and which of them are broken) are pickled to
+# <cache_dir>/registry, see registry_cache.py. When a .T file is read
+# again, and neither its modification time and size (or else its
+# contents) nor the fingerprint of the run changed, its tests are loaded
+# from the cache instead of executing it. The fingerprint covers what the
+# setup functions depend on: the fields of config (except the ones in
+# registry_ignored_fields), the driver, the Python version, the working
+# directory, the git HEAD and notes (with the performance metrics), the
+# database of the metrics backend if it isn't git notes, and the
+# timestamp of the package database. The directories of the tests
+# (opts.srcdir, opts.testdir) are recomputed when loading, as the
+# temporary directory differs between runs.
+#
+# Tests are only stored when all the tests of a .T file were registered
+# (so not with --only), and without framework failures or warnings, so
+# that those are reported again in the next run.
+#
+# A .T file that depends on something not in the fingerprint, such as an
+# environment variable or another file, won't see changes to it while it
+# is cached. That's why the cache is only used with --registry-cache. It
+# also needs Python 3.8 or later (see registry_cache.py); with older
+# versions, the driver executes all .T files.
+
+# Note [Test index]
+#
+# When running only some tests (--only, or TEST= with make), only the .T
+# files that define them need to be executed. To find those, the driver
+# keeps an index from the .T files to the names of the tests they define
+# in <cache_dir>/test_index.json, found by parsing the .T files and
+# looking for calls of test(...) with a literal name (see testindex.py).
+# Files whose modification time or size changed are parsed again.
+#
+# If a test isn't found in the index, for example because its name is
+# computed, all .T files are executed, so that it is still found if it
+# exists, and reported as not found otherwise. .T files that can't be
+# parsed are always executed, to report their errors.
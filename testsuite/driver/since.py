@@ -0,0 +1,74 @@
+#
+# Select the .T files that changes since a git revision could affect.
+# See Note [Selecting tests with --since] in runtests.py.
+#
+
+import os
+import subprocess
+
+def git(args, cwd=None):
+    return subprocess.check_output(['git'] + args, cwd=cwd,
+                                   universal_newlines=True)
+
+# The top directory of the git repository the current directory is in.
+def repo_root():
+    return os.path.normpath(git(['rev-parse', '--show-toplevel']).strip())
+
+# The files (relative to the root of the repository) that differ between
+# the given revision and the working tree, including deleted files, and
+# new files that git doesn't ignore.
+def changed_files(rev, root):
+    changed = git(['diff', '--name-only', '--no-renames', rev, '--'], cwd=root)
+    untracked = git(['ls-files', '--others', '--exclude-standard'], cwd=root)
+    return sorted(set(os.path.normpath(path)
+                      for path in (changed + untracked).splitlines() if path))
+
+# Is path (relative to the root of the repository) one of the given
+# paths, or below one of them?
+def is_below(path, prefixes):
+    return any(path == prefix or path.startswith(prefix.rstrip('/') + '/')
+               for prefix in prefixes)
+
+# Select the .T files that the changed files (relative to root) could
+# affect:
+#
+#  * a changed file below a directory that contains .T files selects the
+#    .T files of the nearest such directory;
+#  * a changed file below one of the paths in dependents selects all the
+#    .T files below the directories that path maps to;
+#  * a changed file below one of the paths in ignore selects nothing;
+#  * any other changed file selects all .T files.
+#
+# Returns the selected .T files, in the order of t_files, and the first
+# changed file that selected all of them, or None.
+def select_t_files(t_files, changed, root, dependents, ignore):
+    t_files_in_dir = {}
+    for t_file in t_files:
+        directory = os.path.dirname(os.path.realpath(t_file))
+        t_files_in_dir.setdefault(directory, []).append(t_file)
+
+    selected = set()
+    for path in changed:
+        if is_below(path, ignore):
+            continue
+
+        directory = os.path.dirname(os.path.join(root, path))
+        while directory not in t_files_in_dir \
+              and os.path.dirname(directory) != directory:
+            directory = os.path.dirname(directory)
+        if directory in t_files_in_dir:
+            selected.update(t_files_in_dir[directory])
+            continue
+
+        dependent_dirs = [os.path.join(root, dependent)
+                          for (prefix, dependents_of_prefix) in dependents.items()
+                          if is_below(path, [prefix])
+                          for dependent in dependents_of_prefix]
+        if dependent_dirs:
+            selected.update(t_file for t_file in t_files
+                            if is_below(os.path.realpath(t_file), dependent_dirs))
+            continue
+
+        return (t_files, path)
+
+    return ([t_file for t_file in t_files if t_file in selected], None)
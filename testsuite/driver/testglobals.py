@@ -26,6 +26,14 @@ class TestConfig:
         self.run_only_some_tests = False
         self.only = set()
 
+        # With --since: which tests (the .T files below these directories,
+        # relative to the root of the repository) changes below other
+        # paths (e.g. a tool in utils/) can affect, and which changed
+        # paths can't affect any test. See Note [Selecting tests with
+        # --since] in runtests.py.
+        self.since_dependents = {}
+        self.since_ignore = []
+
         # Accept new output which differs from the sample?
         self.accept = False
         self.accept_platform = False
@@ -34,6 +42,12 @@ class TestConfig:
         # File in which to save the performance metrics.
         self.metrics_file = ''
 
+        # Where to read the metrics of earlier commits from, and save the
+        # metrics to (unless there is a metrics_file): 'git' (git notes),
+        # 'sqlite' or 'sqlite:PATH'. See Note [Metrics backends] in
+        # perf_notes.py.
+        self.metrics_backend = 'git'
+
         # File in which to save the summary
         self.summary_file = ''
 
@@ -120,10 +134,61 @@ class TestConfig:
         self.timeout_prog = ''
         self.timeout = 300
 
+        # Directory in which the driver keeps data between test runs,
+        # such as the durations of tests.
+        self.cache_dir = ''
+
         # threads
         self.threads = 1
         self.use_threads = False
 
+        # How much memory (in MB) tests declared to use (see
+        # uses_memory) may use at the same time, and how much a test
+        # marked with high_memory_usage uses. See Note [Test resources] in
+        # testlib.py.
+        self.memory_budget = 0
+        self.high_memory_usage = 4096
+
+        # How to run tests in parallel: 'thread' runs every test in a
+        # thread of the driver process, 'process' in a pool of worker
+        # processes. See Note [Process executor] in testlib.py.
+        self.executor = 'thread'
+
+        # At most how many bytes of the output of a command to keep (0 for
+        # all of it), unless a test says otherwise. See Note [Command
+        # output] in testlib.py.
+        self.output_limit = 0
+
+        # At most how many lines of the diff of an output that differs from
+        # the expected one to show (0 for all of them). See Note [Output
+        # diffs] in testlib.py.
+        self.diff_limit = 0
+
+        # Should we replay the results of test cases from the result
+        # cache? See Note [Result cache] in testlib.py.
+        self.result_cache = False
+
+        # Should we load the tests of .T files that haven't changed since
+        # the previous run from a cache, instead of executing the .T
+        # files? See Note [Registry cache] in runtests.py.
+        self.registry_cache = False
+
+        # Should test directories be removed by a background thread? And
+        # how many emptied test directories should it keep for new ones
+        # in every directory of tests? See Note [Background cleanup] in
+        # testlib.py.
+        self.background_cleanup = True
+        self.sandbox_pool = 0
+
+        # At most how many bytes the test directories may take up in a
+        # RAM-backed directory (0 to keep them on disk). See Note
+        # [RAM-backed test directories] in testlib.py.
+        self.workdir_tmpfs = 0
+
+        # Should the driver be a jobserver for the commands of the tests,
+        # such as make? See Note [Jobserver] in testlib.py.
+        self.jobserver = False
+
         # Should we skip performance tests
         self.skip_perf_tests = False
 
@@ -142,7 +207,13 @@ config = TestConfig()
 def getConfig():
     return config
 
+import copy
+import json
 import os
+import time
+
+from perf_notes import PerfStat
+
 # Hold our modified GHC testrunning environment so we don't poison the current
 # python's environment.
 global ghc_env
@@ -154,6 +225,9 @@ ghc_env = os.environ.copy()
 class TestRun:
    def __init__(self):
        self.start_time = None
+       # Only set for the merged results of several runs, see
+       # --merge-results. Otherwise the run ends when the summary is printed.
+       self.end_time = None
        self.total_tests = 0
        self.total_test_cases = 0
 
@@ -176,6 +250,63 @@ class TestRun:
        # NewMetric happens when the previous git commit has no metric recorded.
        self.metrics = []
 
+       # Wall time in seconds spent on each test (all of its ways), by name.
+       self.durations = {}
+
+       # Test cases whose results were replayed from the result cache:
+       # [(directory, name, way)]. See Note [Result cache] in testlib.py.
+       self.cached_results = []
+
+       # Wall time and CPU time of child processes, in seconds, spent in
+       # each phase of each test case:
+       # {source directory/test name: {way: {phase: [wall, cpu]}}}.
+       # See Note [Phase timings] in testlib.py.
+       self.phase_times = {}
+
+       # The most bytes that the test directories of each test, by name,
+       # took up in a RAM-backed directory. See Note [RAM-backed test
+       # directories] in testlib.py.
+       self.sandbox_sizes = {}
+
+   # Add the results recorded in another TestRun, for example by a worker
+   # process, to this one.
+   def merge(self, other):
+       for (field, value) in vars(other).items():
+           if isinstance(value, list):
+               getattr(self, field).extend(value)
+           elif field == 'phase_times':
+               # The ways of a test can be run by different workers.
+               for (test, ways) in value.items():
+                   self.phase_times.setdefault(test, {}).update(ways)
+           elif isinstance(value, dict):
+               getattr(self, field).update(value)
+           elif isinstance(value, int):
+               setattr(self, field, getattr(self, field) + value)
+
+# Save the results of a test run in a JSON file, so that the results of
+# several runs (e.g. shards of one run on different machines, see --shard)
+# can be combined with load_test_run and TestRun.merge later.
+def save_test_run(t, path):
+    results = dict(vars(t))
+    results['start_time'] = time.mktime(t.start_time)
+    results['end_time'] = t.end_time or time.time()
+    with open(path, 'w') as f:
+        json.dump(results, f)
+
+def load_test_run(path):
+    with open(path) as f:
+        results = json.load(f)
+
+    t = TestRun()
+    for (field, value) in results.items():
+        if field == 'metrics':
+            value = [(change, PerfStat(*stat)) for (change, stat) in value]
+        elif isinstance(value, list):
+            value = [tuple(x) if isinstance(x, list) else x for x in value]
+        setattr(t, field, value)
+    t.start_time = time.localtime(t.start_time)
+    return t
+
 global t
 t = TestRun()
 
@@ -185,8 +316,67 @@ def getTestRun():
 # -----------------------------------------------------------------------------
 # Information about the current test
 
+# Note [Copy-on-write test options]
+#
+# Every test starts with a copy of default_testopts, which its setup
+# functions then change. Most tests change only a few fields, so instead
+# of a deep copy, TestOptions.copy makes a shallow copy, which shares the
+# lists and dictionaries (the fields in TestOptions.copy_on_write) with
+# the original. A shared list or dictionary is copied when it is first
+# read from either of the options, because it might be changed in place
+# (e.g. opts.extra_files.extend(...)). A value assigned to a field is
+# not shared until the options are copied again.
+#
+# This only works if the lists and dictionaries only contain values that
+# don't change, such as strings and tuples, as they are not copied
+# deeply.
+#
+# TestOptions has __slots__, so setup functions can't set options that
+# don't exist (e.g. because of a typo), and tests use less memory.
+
+class _CopyOnWrite:
+   def __init__(self, slot, bit):
+       self.slot = slot
+       self.bit = bit
+
+   def __get__(self, opts, cls):
+       if opts is None:
+           return self
+       value = self.slot.__get__(opts, cls)
+       if not opts._owned & self.bit:
+           value = copy.copy(value)
+           self.slot.__set__(opts, value)
+           opts._owned |= self.bit
+       return value
+
+   def __set__(self, opts, value):
+       self.slot.__set__(opts, value)
+       opts._owned |= self.bit
+
 class TestOptions:
+   copy_on_write = ('omit_ways', 'only_ways', 'extra_ways', 'expect_fail_for',
+                    'compiler_always_flags', 'clean_files', 'extra_files',
+                    'stats_range_fields')
+
+   fields = ('skip', 'expect', 'stdin', 'ignore_stdout', 'ignore_stderr',
+             'compile_backpack', 'extra_hc_opts', 'extra_run_opts',
+             'exit_code', 'is_compiler_stats_test', 'alone', 'output_limit',
+             'cpus', 'memory', 'literate', 'c_src', 'objc_src', 'objcpp_src',
+             'cmm_src', 'outputdir', 'pre_cmd', 'cmd_wrapper',
+             'compile_cmd_prefix', 'extra_normaliser', 'check_stdout',
+             'check_hp', 'extra_errmsg_normaliser', 'whitespace_normaliser',
+             'keep_prof_callstacks', 'srcdir', 'testdir', 'combined_output',
+             'compile_timeout_multiplier', 'run_timeout_multiplier',
+             'cleanup', 'local') + copy_on_write
+
+   # Whether the options own (rather than share) the value of each field
+   # in copy_on_write, one bit per field.
+   __slots__ = ('_owned',) + fields[:-len(copy_on_write)] \
+               + tuple('_' + field for field in copy_on_write)
+
    def __init__(self):
+       self._owned = (1 << len(self.copy_on_write)) - 1
+
        # skip this test?
        self.skip = False
 
@@ -247,6 +437,17 @@ class TestOptions:
        # any other threads
        self.alone = False
 
+       # At most how many bytes of the output of a command to keep, or
+       # None for config.output_limit. See Note [Command output] in
+       # testlib.py.
+       self.output_limit = None
+
+       # How many CPUs, and how much memory (in MB) besides what an
+       # ordinary test needs, this test uses while it runs. See Note [Test
+       # resources] in testlib.py.
+       self.cpus = 1
+       self.memory = 0
+
        # Does this test use a literate (.lhs) file?
        self.literate = False
 
@@ -284,9 +485,16 @@ class TestOptions:
        # Extra normalisation for compiler error messages
        self.extra_errmsg_normaliser = lambda x: x
 
+       # Normalisation of whitespace when comparing compiler error
+       # messages (normalise_whitespace if not set)
+       # self.whitespace_normaliser
+
        # Keep profiling callstacks.
        self.keep_prof_callstacks = False
 
+       # The directory the source files of the test are in
+       self.srcdir = '.'
+
        # The directory the test is in
        self.testdir = '.'
 
@@ -303,6 +511,32 @@ class TestOptions:
        # in temporary directory in /tmp? See Note [Running tests in /tmp].
        self.local = True
 
+   # A copy of these options, see Note [Copy-on-write test options].
+   def copy(self):
+       opts = TestOptions.__new__(TestOptions)
+       for slot in TestOptions.__slots__:
+           try:
+               setattr(opts, slot, getattr(self, slot))
+           except AttributeError:
+               # An option that is not set.
+               pass
+       opts._owned = 0
+       self._owned = 0
+       return opts
+
+   # The options that are set, by field.
+   def items(self):
+       for field in self.fields:
+           slot = '_' + field if field in self.copy_on_write else field
+           try:
+               yield (field, getattr(self, slot))
+           except AttributeError:
+               pass
+
+for (bit, field) in enumerate(TestOptions.copy_on_write):
+   setattr(TestOptions, field,
+           _CopyOnWrite(TestOptions.__dict__['_' + field], 1 << bit))
+
 # The default set of options
 global default_testopts
 default_testopts = TestOptions()
@@ -0,0 +1,92 @@
+#
+# An index from test names to the .T files that define them, so that runs
+# of a few tests (--only) only need to execute the .T files of those
+# tests. See Note [Test index] in runtests.py.
+#
+
+import ast
+import json
+import os
+import sys
+
+# String literals are ast.Str before Python 3.8, and ast.Constant from
+# then on (ast.Constant is new in 3.6, and ast.Str deprecated in 3.8).
+if sys.version_info < (3, 8):
+    _Str = ast.Str
+    _Constant = getattr(ast, 'Constant', None)
+else:
+    _Str = None
+    _Constant = ast.Constant
+
+# The value of a string literal, or None if the node isn't one.
+def string_literal(node):
+    if _Constant is not None and isinstance(node, _Constant) \
+       and isinstance(node.value, str):
+        return node.value
+    if _Str is not None and isinstance(node, _Str):
+        return node.s
+    return None
+
+# The names of the tests that the calls of test(...) with a literal name
+# in the given .T source define, or None if it can't be parsed.
+def scan_t_file(src):
+    try:
+        module = ast.parse(src)
+    except (SyntaxError, ValueError):
+        return None
+
+    names = []
+    for node in ast.walk(module):
+        if isinstance(node, ast.Call) \
+           and isinstance(node.func, ast.Name) and node.func.id == 'test' \
+           and node.args \
+           and string_literal(node.args[0]) is not None:
+            names.append(string_literal(node.args[0]))
+    return names
+
+class TestIndex:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+        self.changed = False
+
+    # The names of the tests the .T file defines (see scan_t_file).
+    def names(self, t_file):
+        key = os.path.abspath(t_file)
+        st = os.stat(t_file)
+        stat = [st.st_mtime_ns, st.st_size]
+        entry = self.entries.get(key)
+        if entry is None or entry['stat'] != stat:
+            with open(t_file, 'rb') as f:
+                entry = {'stat': stat, 'names': scan_t_file(f.read())}
+            self.entries[key] = entry
+            self.changed = True
+        return entry['names']
+
+    # Select the .T files that define the given tests, and the ones that
+    # can't be indexed. Returns all of them if some test isn't defined by
+    # a call of test(...) with a literal name, as it could be defined
+    # anywhere.
+    def select(self, t_files, tests):
+        tests = set(tests)
+        missing = set(tests)
+        selected = []
+        for t_file in t_files:
+            names = self.names(t_file)
+            if names is None or not tests.isdisjoint(names):
+                selected.append(t_file)
+                missing.difference_update(names or [])
+        return selected if not missing else t_files
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
@@ -6,29 +6,52 @@
 import io
 import shutil
 import os
+import queue
 import re
 import traceback
 import time
 import datetime
 import copy
+import errno
 import glob
 import sys
 from math import ceil, trunc
 from pathlib import PurePath
 import collections
+import selectors
+import shlex
+import signal
 import subprocess
-
-from testglobals import config, ghc_env, default_testopts, brokens, t
-from testutil import strip_quotes, lndir, link_or_copy_file, passed, failBecause, str_fail, str_pass
+import tempfile
+import threading
+import contextlib
+import functools
+import itertools
+from contextlib import contextmanager
+
+from testglobals import config, ghc_env, default_testopts, brokens, t, TestRun
+from testutil import getStdout, strip_quotes, lndir, link_or_copy_file, clone_tree, passed, failBecause, str_fail, str_pass, Watcher, ResourcePool, JobServer, WorkArea, DirectoryIndex, available_memory, tree_size, ran_out_of_space
 from cpu_features import have_cpu_feature
 import perf_notes as Perf
-from perf_notes import MetricChange
+from perf_notes import MetricChange, PerfStat
+from normaliser import Rule, Normaliser, join_lines, end_lines
+from textdiff import unified_diff
+from result_cache import ResultCache, hash_value, hash_path, hash_file, run_fingerprint
 extra_src_files = {'T4198': ['exitminus1.c']} # TODO: See #12223
 
-global pool_sema
+global test_resources
+# The file descriptors that commands inherit. See Note [Jobserver].
+command_fds = ()
+jobserver = None
 if config.use_threads:
-    import threading
-    pool_sema = threading.BoundedSemaphore(value=config.threads)
+    jobserver = JobServer(config.threads) if config.jobserver else None
+    test_resources = ResourcePool(config.threads, config.memory_budget,
+                                  jobserver)
+    if jobserver is not None:
+        ghc_env['MAKEFLAGS'] = jobserver.makeflags(ghc_env.get('MAKEFLAGS', ''))
+        command_fds = jobserver.fds()
+    if config.executor == 'process':
+        import multiprocessing
 
 global wantToStop
 wantToStop = False
@@ -45,12 +68,22 @@ def stopping():
 # testdir_testopts after each test).
 
 global testopts_local
+# The timings of the phases of the current test case, see
+# Note [Phase timings].
+global phases_local
+# The metrics and framework failures that the current test case recorded
+# (besides in t), see do_test.
+global case_local
 if config.use_threads:
     testopts_local = threading.local()
+    phases_local = threading.local()
+    case_local = threading.local()
 else:
     class TestOpts_Local:
         pass
     testopts_local = TestOpts_Local()
+    phases_local = TestOpts_Local()
+    case_local = TestOpts_Local()
 
 def getTestOpts():
     return testopts_local.x
@@ -71,8 +104,8 @@ def isStatsTest():
 # This can be called at the top of a file of tests, to set default test options
 # for the following tests.
 def setTestOpts( f ):
-    global thisdir_settings
-    thisdir_settings = [thisdir_settings, f]
+    registration = tfile_local.registration
+    registration.settings = [registration.settings, f]
 
 # -----------------------------------------------------------------------------
 # Canned setup functions for common cases.  eg. for a test you might say
@@ -186,6 +219,14 @@ def ignore_stdout(name, opts):
 def ignore_stderr(name, opts):
     opts.ignore_stderr = True
 
+# Keep at most n bytes of the output of every command of the test. See
+# Note [Command output].
+def output_limit(n):
+    return lambda name, opts, n=n: _output_limit(name, opts, n)
+
+def _output_limit(name, opts, n):
+    opts.output_limit = n
+
 def combined_output( name, opts ):
     opts.combined_output = True
 
@@ -214,9 +255,13 @@ def _expect_broken_for( name, opts, bug, ways ):
     opts.expect_fail_for = ways
 
 def record_broken(name, opts, bug):
-    me = (bug, opts.testdir, name)
-    if not me in brokens:
-        brokens.append(me)
+    registration = currentRegistration()
+    if registration is not None:
+        registration.broken.append((bug, name))
+    else:
+        me = (bug, opts.testdir, name)
+        if not me in brokens:
+            brokens.append(me)
 
 def _expect_pass(way):
     # Helper function. Not intended for use in .T files.
@@ -376,12 +421,10 @@ def _collect_stats(name, opts, metric, deviation, is_compiler_stats_test=False):
     if not re.match('^[0-9]*[a-zA-Z][a-zA-Z0-9._-]*$', name):
         failBecause('This test has an invalid name.')
 
-    tests = Perf.get_perf_stats('HEAD^')
-
-    # Might have multiple metrics being measured for a single test.
-    test = [t for t in tests if t.test == name]
+    # See Note [Baselines] in perf_notes.py.
+    baseline = Perf.get_baseline('HEAD^')
 
-    if tests == [] or test == []:
+    if not baseline.has_test(name):
         # There are no prior metrics for this test.
         if isinstance(metric, str):
             if metric == 'all':
@@ -405,8 +448,7 @@ def _collect_stats(name, opts, metric, deviation, is_compiler_stats_test=False):
 
     # get the average value of the given metric from test
     def get_avg_val(metric_2):
-        metric_2_metrics = [float(t.value) for t in test if t.metric == metric_2]
-        return sum(metric_2_metrics) / len(metric_2_metrics)
+        return baseline.average(name, metric_2)
 
     # 'all' is a shorthand to test for bytes allocated, peak megabytes allocated, and max bytes used.
     if isinstance(metric, str):
@@ -494,7 +536,24 @@ def have_readelf( ):
 
 # ---
 
+# See Note [Test resources].
 def high_memory_usage(name, opts):
+    opts.memory = max(opts.memory, config.high_memory_usage)
+
+def uses_memory(mb):
+    return lambda name, opts, mb=mb: _uses_memory(name, opts, mb)
+
+def _uses_memory(name, opts, mb):
+    opts.memory = mb
+
+def uses_cpus(n):
+    return lambda name, opts, n=n: _uses_cpus(name, opts, n)
+
+def _uses_cpus(name, opts, n):
+    opts.cpus = n
+
+# Run the test while no other test runs.
+def exclusive(name, opts):
     opts.alone = True
 
 # If a test is for a multi-CPU race, then running the test alone
@@ -658,13 +717,28 @@ def join_normalisers(*a):
             else:
                 yield el
 
-    a = flatten(a)
-
-    fn = lambda x:x # identity function
-    for f in a:
+    # Apply the functions one after the other, instead of nesting lambdas,
+    # which setup functions that add normalisers would nest deeper and
+    # deeper. See Note [Compiled normalisers].
+    fs = []
+    for f in flatten(a):
         assert callable(f)
-        fn = lambda x,f=f,fn=fn: fn(f(x))
-    return fn
+        if isinstance(f, Normaliser):
+            fs.extend(reversed(f.steps))
+        else:
+            fs.append(f)
+    fs = tuple(reversed(fs))
+
+    # The same functions give the same Normaliser, so that normalised
+    # expected outputs can be remembered by it. See Note [Fast output
+    # comparison].
+    try:
+        return joined_normalisers.setdefault(fs, Normaliser(fs))
+    except TypeError:
+        # An unhashable callable.
+        return Normaliser(fs)
+
+joined_normalisers = {}
 
 # ----
 # Function for composing two opt-fns together
@@ -681,23 +755,66 @@ def executeSetups(fs, name, opts):
 # -----------------------------------------------------------------------------
 # The current directory of tests
 
+# Note [Loading .T files]
+#
+# The driver executes the .T files of different directories in parallel
+# (with --threads), as their setup functions can take a while, for
+# example when they run ghc-pkg (reqlib) or git (collect_stats).
+#
+# So executing a .T file doesn't register its tests right away. Instead,
+# test() and setTestOpts() work on the TFileRegistration of the .T file
+# that the current thread is executing (tfile_local.registration), which
+# collects its tests, and the tests marked broken. Once all .T files are
+# executed, their registrations are registered (registerTFile) in the
+# order of the .T files, so the tests, duplicate tests and config.only
+# are handled as if the .T files were executed one after the other.
+#
+# Every .T file is executed with its own copy of the globals of the
+# driver, so the definitions of one .T file (e.g. a normaliser called f)
+# don't clobber the definitions of another.
+
+# What a .T file registered. See Note [Loading .T files].
+class TFileRegistration:
+    def __init__(self, tempdir, dir):
+        self.tempdir = tempdir
+        self.dir = dir
+        # The options for this test directory
+        def settings(name, opts, tempdir=tempdir, dir=dir):
+            return _newTestDir(name, opts, tempdir, dir)
+        self.settings = settings
+        # [TestEntry]
+        self.tests = []
+        # Tests marked broken: [(bug, name)]
+        self.broken = []
+        # The number of framework failures and warnings
+        self.problems = 0
+
+# The registration of the .T file that the current thread is executing,
+# if any.
+tfile_local = threading.local()
+
+# Start executing a .T file in the given directory in the current thread.
 def newTestDir(tempdir, dir):
+    tfile_local.registration = TFileRegistration(tempdir, dir)
+    return tfile_local.registration
 
-    global thisdir_settings
-    # reset the options for this test directory
-    def settings(name, opts, tempdir=tempdir, dir=dir):
-        return _newTestDir(name, opts, tempdir, dir)
-    thisdir_settings = settings
+def currentRegistration():
+    return getattr(tfile_local, 'registration', None)
 
 # Should be equal to entry in toplevel .gitignore.
 testdir_suffix = '.run'
 
 def _newTestDir(name, opts, tempdir, dir):
-    testdir = os.path.join('', *(p for p in PurePath(dir).parts if p != '..'))
-    opts.srcdir = os.path.join(os.getcwd(), dir)
-    opts.testdir = os.path.join(tempdir, testdir, name + testdir_suffix)
+    (opts.srcdir, opts.testdir) = testDirs(name, tempdir, dir)
     opts.compiler_always_flags = config.compiler_always_flags
 
+# The source directory, and the directory to run the test in, of a test in
+# the given directory.
+def testDirs(name, tempdir, dir):
+    testdir = os.path.join('', *(p for p in PurePath(dir).parts if p != '..'))
+    return (os.path.join(os.getcwd(), dir),
+            os.path.join(tempdir, testdir, name + testdir_suffix))
+
 # -----------------------------------------------------------------------------
 # Actually doing tests
 
@@ -705,32 +822,99 @@ parallelTests = []
 aloneTests = []
 allTestNames = set([])
 
-def runTest(watcher, opts, name, func, args):
-    if config.use_threads:
-        pool_sema.acquire()
-        t = threading.Thread(target=test_common_thread,
-                             name=name,
-                             args=(watcher, name, opts, func, args))
+# Every registered test, by name. See Note [Process executor].
+testRegistry = {}
+
+class TestEntry:
+    def __init__(self, name, opts, func, args):
+        self.name = name
+        self.opts = opts
+        self.func = func
+        self.args = args
+
+    # The cases of the test to run. See Note [Test cases].
+    def cases(self):
+        return expandTest(self)
+
+# One way of a test to run.
+class TestCase:
+    def __init__(self, ways, way):
+        self.ways = ways
+        self.way = way
+        self.name = ways.test.name
+
+    def __call__(self, watcher):
+        runTestCase(watcher, self.ways, self.way)
+
+def runTestCase(watcher, ways, way):
+    name = ways.test.name
+    if config.use_threads and config.executor == 'process':
+        runTestCaseInProcess(watcher, ways, way)
+    elif config.use_threads:
+        share = acquireTestResources(ways.test.opts)
+        reservation = reserveWorkArea(name)
+        startTestCase(ways)
+        t = threading.Thread(target=test_case_thread,
+                             name=name + '(' + way + ')',
+                             args=(watcher, share, reservation, ways, way))
         t.daemon = False
         t.start()
     else:
-        test_common_work(watcher, name, opts, func, args)
+        reservation = reserveWorkArea(name)
+        startTestCase(ways)
+        start_time = time.monotonic()
+        try:
+            test_case_work(name, way, reservation is not None)
+        finally:
+            releaseWorkArea(name, reservation)
+            finishTestCase(ways, time.monotonic() - start_time)
+            watcher.notify()
 
 # name  :: String
 # setup :: [TestOpt] -> IO ()
 def test(name, setup, func, args):
-    global aloneTests
-    global parallelTests
-    global allTestNames
-    global thisdir_settings
-    if name in allTestNames:
-        framework_fail(name, 'duplicate', 'There are multiple tests with this name')
+    registration = tfile_local.registration
     if not re.match('^[0-9]*[a-zA-Z][a-zA-Z0-9._-]*$', name):
         framework_fail(name, 'bad_name', 'This test has an invalid name')
 
+    # See Note [Mutating config.only]
+    if config.run_only_some_tests and name not in config.only:
+        return
+
+    # Make a copy of the default_testopts, as we need our own copy of any
+    # dictionaries etc inside it. Otherwise, if one test modifies them,
+    # all tests will see the modified version! See Note [Copy-on-write
+    # test options] in testglobals.py.
+    myTestOpts = default_testopts.copy()
+
+    executeSetups([registration.settings, setup], name, myTestOpts)
+
+    registration.tests.append(TestEntry(name, myTestOpts, func, args))
+
+# Register the tests, and the broken tests, of a .T file, in the order of
+# the .T files. See Note [Loading .T files]. Only the directories of the
+# tests depend on the run, so registrations loaded from the registry
+# cache (see Note [Registry cache] in runtests.py) get them again.
+def registerTFile(registration):
+    for (bug, name) in registration.broken:
+        me = (bug, testDirs(name, registration.tempdir, registration.dir)[1], name)
+        if not me in brokens:
+            brokens.append(me)
+    for test in registration.tests:
+        if isSelectedTest(test.name):
+            (test.opts.srcdir, test.opts.testdir) = \
+                testDirs(test.name, registration.tempdir, registration.dir)
+            registerTest(test)
+
+# Check that a new test is not a duplicate, and whether it should be run
+# at all.
+def isSelectedTest(name):
+    if name in allTestNames:
+        framework_fail(name, 'duplicate', 'There are multiple tests with this name')
+
     if config.run_only_some_tests:
         if name not in config.only:
-            return
+            return False
         else:
             # Note [Mutating config.only]
             # config.only is initially the set of tests requested by
@@ -739,26 +923,243 @@ def test(name, setup, func, args):
             # report on any tests we couldn't find and error out.
             config.only.remove(name)
 
-    # Make a deep copy of the default_testopts, as we need our own copy
-    # of any dictionaries etc inside it. Otherwise, if one test modifies
-    # them, all tests will see the modified version!
-    myTestOpts = copy.deepcopy(default_testopts)
-
-    executeSetups([thisdir_settings, setup], name, myTestOpts)
+    return True
 
-    thisTest = lambda watcher: runTest(watcher, myTestOpts, name, func, args)
-    if myTestOpts.alone:
+def registerTest(thisTest):
+    if thisTest.opts.alone:
         aloneTests.append(thisTest)
     else:
         parallelTests.append(thisTest)
-    allTestNames.add(name)
+    allTestNames.add(thisTest.name)
+    testRegistry[thisTest.name] = thisTest
 
 if config.use_threads:
-    def test_common_thread(watcher, name, opts, func, args):
+    def test_case_thread(watcher, share, reservation, ways, way):
+            start_time = time.monotonic()
             try:
-                test_common_work(watcher, name, opts, func, args)
+                test_case_work(ways.test.name, way, reservation is not None)
             finally:
-                pool_sema.release()
+                releaseWorkArea(ways.test.name, reservation)
+                test_resources.release(share)
+                finishTestCase(ways, time.monotonic() - start_time)
+                watcher.notify()
+
+# Note [Test resources]
+#
+# When running tests in parallel, every test declares what each of its
+# cases (see Note [Test cases]) needs while it runs:
+#
+#  * CPUs (opts.cpus, set with uses_cpus, default 1). There are as many as
+#    --threads.
+#
+#  * Memory, in MB (opts.memory, set with uses_memory or
+#    high_memory_usage, default 0). Ordinary tests don't need to declare
+#    their memory use, only tests that need a lot of it do. Together they
+#    may use at most config.memory_budget (--memory-budget, by default
+#    half of the physical memory).
+#
+#  * The whole machine (opts.alone, set with exclusive or multi_cpu_race),
+#    for tests that must not run in parallel with any other test.
+#
+# The driver starts the tests one by one, in order, and before starting a
+# test waits until enough CPUs and memory are free. A test that needs more
+# than there is gets everything, and runs alone. Tests that must run alone
+# are started first, when no other tests would be waiting for them.
+
+def acquireTestResources(opts):
+    return test_resources.acquire(opts.cpus, opts.memory, opts.alone)
+
+# Note [Jobserver]
+#
+# Some tests run commands that run jobs in parallel themselves, e.g.
+# 'make -j' in a run_command test. With --jobserver, the driver makes
+# sure that at most --threads jobs run at any time, its own tests
+# included: it acts as a GNU make jobserver with a token for each of the
+# --threads CPU slots (see Note [Test resources] and JobServer).
+#
+# Before starting a test, the driver takes a token for every CPU the test
+# uses, and it puts them back when the test is done. The commands of the
+# tests inherit the pipe of the jobserver, and find it in MAKEFLAGS, so
+# that every make run by a test takes a token from the driver for every
+# job it runs besides its first (which runs on the token of the test).
+# Tokens that are lost, because a make was killed before it could put
+# them back, are put back when the driver has been waiting for tokens for
+# a second and no command of any test is running (JobServer counts them,
+# in worker processes too): then all the tokens that the driver doesn't
+# hold for its tests belong in the pipe. Tokens can't be put back earlier,
+# as it isn't known which of the commands still running hold the others.
+#
+# Tests that run make in parallel must be written for that, which is why
+# this is off by default. GHC doesn't take part: 'ghc -j' doesn't use a
+# make jobserver.
+
+# Note [RAM-backed test directories]
+#
+# With --workdir-tmpfs=SIZE (and without LOCAL=1), test directories are
+# created in a RAM-backed directory (a tmpfs, such as /dev/shm) instead of
+# the temporary directory on disk, as long as they take up at most SIZE
+# bytes (or the free space of the tmpfs, if that is less) together:
+#
+#  * Before a test starts, the driver reserves as many bytes for it as
+#    the test directory (and its template, see Note [Test directory
+#    templates]) of the test took up at most in the previous run, or
+#    default_sandbox_size if the test hasn't been run before. These sizes
+#    are saved in <cache dir>/sandbox_sizes.json.
+#
+#  * If the reservation doesn't fit, the test directories of the test
+#    spill to disk: the test runs in its usual test directory. It also
+#    doesn't fit if it would leave less free space in the tmpfs than
+#    some headroom (default_sandbox_size per thread, or a quarter of the
+#    budget if that is less), for the tests that write more than they
+#    reserved: reservations are not enforced while tests run.
+#
+#  * A test case that failed because it ran out of space in the tmpfs
+#    anyway (the driver got ENOSPC, or a command wrote "No space left on
+#    device" to a stdout or stderr file in the test directory, see
+#    ran_out_of_space) is run again on disk, and only the result of that
+#    run counts. The size of its test directory on disk is recorded, so
+#    the next run reserves enough for it. The outputs are only looked at
+#    when the test case failed, so passing tests cost nothing extra; a
+#    failing test that prints that message for other reasons is run
+#    again on disk needlessly, with the same result.
+#
+#  * When the test is done, its reservation is given back, except for
+#    what the test directory still takes up when it isn't cleaned up.
+#
+# What is left: a test that runs out of space can make others that run
+# in the tmpfs at the same time run out of space as well (they are run
+# again on disk too), and a test whose output doesn't mention running
+# out of space when it does isn't run again.
+#
+# As files in a tmpfs take up memory, no test is put in the tmpfs, and
+# no test is started while others are running (see Note [Test
+# resources]), while the available memory of the machine is low: less
+# than a sixteenth of its physical memory.
+#
+# The tests only know their test directory on disk (opts.testdir); a test
+# that runs in the tmpfs runs with a copy of its options with the test
+# directory moved there (see WorkArea.relocate).
+
+work_area = None
+
+# The bytes reserved for a test of which we don't know better.
+default_sandbox_size = 64 * 2**20
+
+# {test name: bytes}, from the previous runs.
+sandbox_sizes = {}
+
+def setupWorkArea(disk_dir, ram_dir, budget, low_memory, sizes):
+    global work_area, sandbox_sizes
+    work_area = WorkArea(disk_dir, ram_dir, budget,
+                         min(config.threads * default_sandbox_size, budget // 4))
+    sandbox_sizes = sizes
+
+    def memory_low():
+        available = available_memory()
+        return available is not None and available < low_memory
+    work_area.memory_low = memory_low
+    if config.use_threads:
+        test_resources.memory_low = memory_low
+
+# Reserve room for the test directories of the test in the work area.
+# Returns the reservation, or None if they have to be on disk.
+def reserveWorkArea(name):
+    if work_area is None:
+        return None
+    return work_area.reserve(sandbox_sizes.get(name, default_sandbox_size))
+
+def releaseWorkArea(name, reservation):
+    if reservation is not None:
+        left = 0 if config.cleanup else t.sandbox_sizes.get(name, reservation)
+        work_area.release(reservation, left)
+
+# Note [Process executor]
+#
+# With --executor=process, tests are not run in threads of the driver but
+# in a pool of worker processes, so that the Python side of running a
+# test (normalising and comparing outputs, bookkeeping) is not serialised
+# by the GIL of a single process.
+#
+# TestOptions contain lambdas, which cannot be pickled. So instead of
+# sending tests to the workers, the pool is forked after all .T files
+# have been read, and the workers look up tests by name in their
+# inherited copy of testRegistry. Each worker records the results of a
+# test in a fresh TestRun, which is sent back and merged into the TestRun
+# of the driver.
+#
+# Like threads, the tests acquire their resources (see Note [Test
+# resources]) in the driver before they are sent to a worker, so the pool
+# doesn't need more than config.threads workers.
+
+process_pool = None
+
+def getProcessPool():
+    global process_pool
+    if process_pool is None:
+        # Don't let the workers inherit (and later print again) buffered
+        # output.
+        sys.stdout.flush()
+        process_pool = multiprocessing.get_context('fork').Pool(
+                           processes=config.threads,
+                           initializer=initProcessWorker)
+    return process_pool
+
+def initProcessWorker():
+    # ^C is handled by the driver.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if run_directly:
+        # See stopCommands.
+        def terminate(signum, frame):
+            killRunningCommands()
+            os._exit(1)
+        signal.signal(signal.SIGTERM, terminate)
+
+def stopProcessPool():
+    if process_pool is not None:
+        if stopping():
+            process_pool.terminate()
+        else:
+            process_pool.close()
+        process_pool.join()
+
+def runTestCaseInProcess(watcher, ways, way):
+    name = ways.test.name
+    share = acquireTestResources(ways.test.opts)
+    reservation = reserveWorkArea(name)
+    startTestCase(ways)
+    start_time = time.monotonic()
+
+    def done(result):
+        (test_run, stop) = result
+        sandbox_size = t.sandbox_sizes.get(name, 0)
+        t.merge(test_run)
+        if name in t.sandbox_sizes:
+            t.sandbox_sizes[name] = max(sandbox_size, t.sandbox_sizes[name])
+        releaseWorkArea(name, reservation)
+        test_resources.release(share)
+        if stop:
+            stopNow()
+        finishTestCase(ways, time.monotonic() - start_time)
+        watcher.notify()
+
+    def failed(e):
+        releaseWorkArea(name, reservation)
+        test_resources.release(share)
+        setLocalTestOpts(ways.test.opts)
+        framework_fail(name, way, 'Unhandled exception in worker process: ' + str(e))
+        finishTestCase(ways, time.monotonic() - start_time)
+        watcher.notify()
+
+    getProcessPool().apply_async(test_case_process,
+                                 (name, way, reservation is not None),
+                                 callback=done, error_callback=failed)
+
+def test_case_process(name, way, in_work_area):
+    global t
+    t = TestRun()
+    test_case_work(name, way, in_work_area)
+    sys.stdout.flush()
+    return (t, stopping())
 
 def get_package_cache_timestamp():
     if config.package_conf_cache_file == '':
@@ -771,64 +1172,70 @@ def get_package_cache_timestamp():
 
 do_not_copy = ('.hi', '.o', '.dyn_hi', '.dyn_o', '.out') # 12112
 
-def test_common_work(watcher, name, opts, func, args):
-    try:
-        t.total_tests += 1
-        setLocalTestOpts(opts)
-
-        package_conf_cache_file_start_timestamp = get_package_cache_timestamp()
-
-        # All the ways we might run this test
-        if func == compile or func == multimod_compile:
-            all_ways = config.compile_ways
-        elif func == compile_and_run or func == multimod_compile_and_run:
-            all_ways = config.run_ways
-        elif func == ghci_script:
-            if 'ghci' in config.run_ways:
-                all_ways = ['ghci']
-            else:
-                all_ways = []
-        else:
-            all_ways = ['normal']
-
-        # A test itself can request extra ways by setting opts.extra_ways
-        all_ways = all_ways + [way for way in opts.extra_ways if way not in all_ways]
-
-        t.total_test_cases += len(all_ways)
-
-        ok_way = lambda way: \
-            not getTestOpts().skip \
-            and (getTestOpts().only_ways == None or way in getTestOpts().only_ways) \
-            and (config.cmdline_ways == [] or way in config.cmdline_ways) \
-            and (not (config.skip_perf_tests and isStatsTest())) \
-            and (not (config.only_perf_tests and not isStatsTest())) \
-            and way not in getTestOpts().omit_ways
-
-        # Which ways we are asked to skip
-        do_ways = list(filter (ok_way,all_ways))
-
-        # Only run all ways in slow mode.
-        # See Note [validate and testsuite speed] in toplevel Makefile.
-        if config.accept:
-            # Only ever run one way
-            do_ways = do_ways[:1]
-        elif config.speed > 0:
-            # However, if we EXPLICITLY asked for a way (with extra_ways)
-            # please test it!
-            explicit_ways = list(filter(lambda way: way in opts.extra_ways, do_ways))
-            other_ways = list(filter(lambda way: way not in opts.extra_ways, do_ways))
-            do_ways = other_ways[:1] + explicit_ways
+# Note [Test cases]
+#
+# Every way of a test (a test case) is scheduled on its own: before any
+# test is run, the tests are expanded into their cases (expandTest),
+# which are started one by one as resources become free (see Note [Test
+# resources]). So the ways of a test that is run in many ways can run at
+# the same time, instead of one after the other in one thread.
+#
+# The cases of a test share:
+#
+#  * the files copied into their test directories, found once (in every
+#    worker process, see Note [Process executor]) by TestWays.getFiles;
+#
+#  * the template of their test directories, see Note [Test directory
+#    templates];
+#
+#  * the checks of the whole test, which the driver does when the last
+#    case is done (finishTest): the package database cache must not have
+#    changed since the first case started, and the duration of the test
+#    (see Note [Longest tests first] in runtests.py) is the sum of the
+#    durations of its cases.
+#
+# As the cases of a test may run at the same time, each gets a test
+# directory of its own: <name>.<way>.run, unless the test is run in one
+# way only (<name>.run). The results are reported with the test directory
+# of the test all the same (testDirectory).
+
+# The ways of a test to run, by test name. See Note [Test cases].
+testWays = {}
+
+class TestWays:
+    def __init__(self, test, do_ways):
+        self.test = test
+        self.do_ways = do_ways
+        self.lock = threading.Lock()
+        self.files = None
+        # {test directory of the test: TestDirTemplate}
+        self.templates = {}
+
+        # Only used in the driver.
+        self.remaining = len(do_ways)
+        self.duration = 0
+        self.package_conf_cache_file_timestamp = None
+
+    def getFiles(self):
+        with self.lock:
+            if self.files is None:
+                self.files = self._findFiles()
+            return self.files
+
+    def _findFiles(self):
+        name = self.test.name
+        opts = self.test.opts
 
         # Find all files in the source directory that this test
-        # depends on. Do this only once for all ways.
+        # depends on. Do this only once for all ways (in every process).
         # Generously add all filenames that start with the name of
         # the test to this set, as a convenience to test authors.
         # They will have to use the `extra_files` setup function to
         # specify all other files that their test depends on (but
         # this seems to be necessary for only about 10% of all
         # tests).
-        files = set(f for f in os.listdir(opts.srcdir)
-                       if f.startswith(name) and not f == name and
+        files = set(f for f in srcdirIndex(opts.srcdir).starting_with(name)
+                       if not f == name and
                           not f.endswith(testdir_suffix) and
                           not os.path.splitext(f)[1] in do_not_copy)
         for filename in (opts.extra_files + extra_src_files.get(name, [])):
@@ -848,37 +1255,177 @@ def test_common_work(watcher, name, opts, func, args):
             else:
                 framework_fail(name, 'whole-test', 'extra_file is empty string')
 
-        # Run the required tests...
-        for way in do_ways:
-            if stopping():
-                break
-            try:
-                do_test(name, way, func, args, files)
-            except KeyboardInterrupt:
-                stopNow()
-            except Exception as e:
-                framework_fail(name, way, str(e))
-                traceback.print_exc()
-
-        t.n_tests_skipped += len(set(all_ways) - set(do_ways))
+        return files
+
+    # The template for the test directories in the directory of the given
+    # test directory of the test, or None if there is just one way.
+    def getTemplate(self, testdir):
+        if len(self.do_ways) < 2:
+            return None
+        with self.lock:
+            if testdir not in self.templates:
+                self.templates[testdir] = TestDirTemplate(testdir)
+            return self.templates[testdir]
+
+    # The test directory of a case.
+    def caseTestDir(self, testdir, way):
+        if len(self.do_ways) < 2:
+            return testdir
+        return testdir[:-len(testdir_suffix)] + '.' + way + testdir_suffix
+
+def expandTest(test):
+    name = test.name
+    opts = test.opts
+    func = test.func
+    setLocalTestOpts(opts)
+    t.total_tests += 1
+
+    # All the ways we might run this test
+    if func == compile or func == multimod_compile:
+        all_ways = config.compile_ways
+    elif func == compile_and_run or func == multimod_compile_and_run:
+        all_ways = config.run_ways
+    elif func == ghci_script:
+        if 'ghci' in config.run_ways:
+            all_ways = ['ghci']
+        else:
+            all_ways = []
+    else:
+        all_ways = ['normal']
+
+    # A test itself can request extra ways by setting opts.extra_ways
+    all_ways = all_ways + [way for way in opts.extra_ways if way not in all_ways]
+
+    t.total_test_cases += len(all_ways)
+
+    ok_way = lambda way: \
+        not getTestOpts().skip \
+        and (getTestOpts().only_ways == None or way in getTestOpts().only_ways) \
+        and (config.cmdline_ways == [] or way in config.cmdline_ways) \
+        and (not (config.skip_perf_tests and isStatsTest())) \
+        and (not (config.only_perf_tests and not isStatsTest())) \
+        and way not in getTestOpts().omit_ways
+
+    # Which ways we are asked to skip
+    do_ways = list(filter (ok_way,all_ways))
+
+    # Only run all ways in slow mode.
+    # See Note [validate and testsuite speed] in toplevel Makefile.
+    if config.accept:
+        # Only ever run one way
+        do_ways = do_ways[:1]
+    elif config.speed > 0:
+        # However, if we EXPLICITLY asked for a way (with extra_ways)
+        # please test it!
+        explicit_ways = list(filter(lambda way: way in opts.extra_ways, do_ways))
+        other_ways = list(filter(lambda way: way not in opts.extra_ways, do_ways))
+        do_ways = other_ways[:1] + explicit_ways
+
+    t.n_tests_skipped += len(set(all_ways) - set(do_ways))
+
+    ways = TestWays(test, do_ways)
+    testWays[name] = ways
+    if len(do_ways) > 1:
+        # Left behind by an interrupted run, see Note [Test directory
+        # templates].
+        removeDir(TestDirTemplate(opts.testdir).path)
+    return [TestCase(ways, way) for way in do_ways]
+
+# In the driver, before a case of the test is started.
+def startTestCase(ways):
+    with ways.lock:
+        if ways.package_conf_cache_file_timestamp is None:
+            ways.package_conf_cache_file_timestamp = get_package_cache_timestamp()
+
+# In the driver, when a case of the test is done.
+def finishTestCase(ways, duration):
+    with ways.lock:
+        ways.duration += duration
+        ways.remaining -= 1
+        if ways.remaining > 0:
+            return
+    finishTest(ways)
 
-        if config.cleanup and do_ways:
-            try:
-                cleanup()
-            except Exception as e:
-                framework_fail(name, 'runTest', 'Unhandled exception during cleanup: ' + str(e))
+def finishTest(ways):
+    name = ways.test.name
+    setLocalTestOpts(ways.test.opts)
+    try:
+        if len(ways.do_ways) > 1:
+            testdirs = [ways.test.opts.testdir]
+            if work_area is not None:
+                testdirs.append(work_area.relocate(ways.test.opts.testdir))
+            for testdir in testdirs:
+                TestDirTemplate(testdir).remove()
 
         package_conf_cache_file_end_timestamp = get_package_cache_timestamp();
 
-        if package_conf_cache_file_start_timestamp != package_conf_cache_file_end_timestamp:
-            framework_fail(name, 'whole-test', 'Package cache timestamps do not match: ' + str(package_conf_cache_file_start_timestamp) + ' ' + str(package_conf_cache_file_end_timestamp))
+        if ways.package_conf_cache_file_timestamp != package_conf_cache_file_end_timestamp:
+            framework_fail(name, 'whole-test', 'Package cache timestamps do not match: ' + str(ways.package_conf_cache_file_timestamp) + ' ' + str(package_conf_cache_file_end_timestamp))
+
+        # Remember how long this test took, to schedule it better next
+        # time. See Note [Longest tests first] in runtests.py.
+        if not stopping():
+            t.durations[name] = ways.duration
+    except Exception as e:
+        framework_fail(name, 'runTest', 'Unhandled exception: ' + str(e))
+
+def test_case_work(name, way, in_work_area):
+    ways = testWays[name]
+    test = ways.test
+    try:
+        opts = test.opts.copy()
+        if in_work_area:
+            # See Note [RAM-backed test directories].
+            opts.testdir = work_area.relocate(opts.testdir)
+        template = ways.getTemplate(opts.testdir)
+        opts.testdir = ways.caseTestDir(opts.testdir, way)
+        setLocalTestOpts(opts)
+
+        spill = None
+        if in_work_area:
+            disk_opts = test.opts.copy()
+            spill = (disk_opts, ways.getTemplate(disk_opts.testdir))
+            disk_opts.testdir = ways.caseTestDir(disk_opts.testdir, way)
+
+        if stopping():
+            return
+        files = ways.getFiles()
+
+        phases_local.times = None
+        try:
+            do_test(name, way, test.func, test.args, files, template, spill)
+        except KeyboardInterrupt:
+            stopNow()
+        except Exception as e:
+            framework_fail(name, way, str(e))
+            traceback.print_exc()
+
+        # do_test may have run the test on disk after all.
+        opts = getTestOpts()
+        template = spill[1] if spill and opts is spill[0] else template
+
+        if in_work_area:
+            size = tree_size(opts.testdir)
+            if template:
+                size += tree_size(template.path)
+            t.sandbox_sizes[name] = max(size, t.sandbox_sizes.get(name, 0))
+
+        if config.cleanup:
+            try:
+                # Counts towards the phases of the way.
+                with phase('cleanup'):
+                    cleanup()
+            except Exception as e:
+                framework_fail(name, way, 'Unhandled exception during cleanup: ' + str(e))
+        phases_local.times = None
 
     except Exception as e:
         framework_fail(name, 'runTest', 'Unhandled exception: ' + str(e))
-    finally:
-        watcher.notify()
 
-def do_test(name, way, func, args, files):
+# spill: the options and template to run the test case with on disk, if
+# it runs in the tmpfs and runs out of space there. See Note [RAM-backed
+# test directories].
+def do_test(name, way, func, args, files, template=None, spill=None):
     opts = getTestOpts()
 
     full_name = name + '(' + way + ')'
@@ -889,10 +1436,320 @@ def do_test(name, way, func, args, files):
          len(t.unexpected_failures),
          len(t.framework_failures)]))
 
+    directory = testDirectory(name)
+
+    # See Note [Phase timings].
+    phases_local.times = t.phase_times.setdefault(phaseTimesKey(name, opts), {}) \
+                              .setdefault(way, {})
+    phases_local.current = None
+
+    # See Note [Result cache].
+    cache_key = None
+    cached = None
+    if result_cache:
+        cache_key = resultCacheKey(name, way, func, args, files)
+        cached = result_cache.lookup(cache_key)
+
+    if cached:
+        if_verbose(3, '=====> {0} replayed from the result cache'.format(full_name))
+        result = cached['result']
+        t.metrics.extend((change, PerfStat(*stat))
+                         for (change, stat) in cached['metrics'])
+        t.cached_results.append((directory, name, way))
+    else:
+        # Other test cases record theirs in t at the same time.
+        case_local.metrics = []
+        case_local.framework_failures = []
+        try:
+            result = run_test_way(name, way, func, args, files, template)
+            # Only a failure can be because of the tmpfs.
+            out_of_space = spill is not None \
+                           and not (result and result.get('passFail') == 'pass') \
+                           and ran_out_of_space(opts.testdir)
+        except OSError as e:
+            if spill is None or e.errno != errno.ENOSPC:
+                raise
+            out_of_space = True
+
+        if out_of_space:
+            if_verbose(1, '*** {0} ran out of space in the tmpfs, running it again on disk'
+                              .format(full_name))
+            forgetTestCase()
+            with phase('cleanup'):
+                cleanup()
+            (opts, template) = spill
+            setLocalTestOpts(opts)
+            result = run_test_way(name, way, func, args, files, template)
+
+    if opts.expect not in ['pass', 'fail', 'missing-lib']:
+        framework_fail(name, way, 'bad expected ' + opts.expect)
+
+    try:
+        passFail = result['passFail']
+    except (KeyError, TypeError):
+        passFail = 'No passFail found'
+
+    if passFail == 'pass':
+        if _expect_pass(way):
+            t.expected_passes.append((directory, name, way))
+            t.n_expected_passes += 1
+        else:
+            if_verbose(1, '*** unexpected pass for %s' % full_name)
+            t.unexpected_passes.append((directory, name, 'unexpected', way))
+    elif passFail == 'fail':
+        if _expect_pass(way):
+            reason = result['reason']
+            tag = result.get('tag')
+            if tag == 'stat':
+                if_verbose(1, '*** unexpected stat test failure for %s' % full_name)
+                t.unexpected_stat_failures.append((directory, name, reason, way))
+            else:
+                if_verbose(1, '*** unexpected failure for %s' % full_name)
+                t.unexpected_failures.append((directory, name, reason, way))
+        else:
+            if opts.expect == 'missing-lib':
+                t.missing_libs.append((directory, name, 'missing-lib', way))
+            else:
+                t.n_expected_failures += 1
+    else:
+        framework_fail(name, way, 'bad result ' + passFail)
+
+    if cache_key and not cached:
+        storeCachedResult(cache_key, name, way, result,
+                          case_local.metrics, case_local.framework_failures)
+    case_local.metrics = None
+    case_local.framework_failures = None
+
+# Record a metric of the current test case.
+def recordMetric(metric):
+    t.metrics.append(metric)
+    if getattr(case_local, 'metrics', None) is not None:
+        case_local.metrics.append(metric)
+
+# Forget the metrics and framework failures that the current test case
+# recorded, to run it again.
+def forgetTestCase():
+    for metric in case_local.metrics:
+        t.metrics.remove(metric)
+    for failure in case_local.framework_failures:
+        t.framework_failures.remove(failure)
+    case_local.metrics = []
+    case_local.framework_failures = []
+
+def run_test_way(name, way, func, args, files, template):
+    opts = getTestOpts()
+
     # Clean up prior to the test, so that we can't spuriously conclude
     # that it passed on the basis of old run outputs.
-    cleanup()
-    os.makedirs(opts.testdir)
+    with phase('cleanup'):
+        cleanup()
+    with phase('setup'):
+        if template and template.ready():
+            clone_tree(template.path, opts.testdir)
+        else:
+            setup_testdir(name, way, func, files)
+            if template:
+                template.save(opts.testdir)
+
+    if opts.pre_cmd:
+        with phase('pre_cmd'):
+            exit_code = runCmd(override_options(opts.pre_cmd),
+                               stderr = subprocess.STDOUT,
+                               print_output = config.verbose >= 3,
+                               cwd = opts.testdir)
+
+        # If user used expect_broken then don't record failures of pre_cmd
+        if exit_code != 0 and opts.expect not in ['fail']:
+            framework_fail(name, way, 'pre_cmd failed: {0}'.format(exit_code))
+            if_verbose(1, '** pre_cmd was "{0}".'.format(override_options(opts.pre_cmd)))
+
+    # Whatever the test function does outside of compiling and comparing
+    # outputs counts as running the test.
+    with phase('run'):
+        return func(*[name,way] + args)
+
+# Note [Result cache]
+#
+# With --result-cache, the driver remembers the result of every test case
+# in <cache_dir>/results, by a hash of everything that can affect it:
+#
+#  * the compiler, the files in its libdir and in the directories of
+#    the packages in its global package database (by size and
+#    modification time: these include the shared libraries that a
+#    dynamically linked compiler loads, which are outside the libdir in
+#    a build tree), and its `--info`,
+#  * the driver and the makefiles of the testsuite,
+#  * the way, and its compiler and RTS flags,
+#  * the test: its name, options (including the functions in them, by
+#    their code and the values they close over), test function and
+#    arguments,
+#  * the contents of the files that are copied into the test directory,
+#    and of the .T files in its source directory,
+#  * the test environment, and the allowed performance changes for the
+#    test.
+#
+# When a test case with the same hash was run before, the driver doesn't
+# run it again, but replays its result, and the metrics it measured. Such
+# results are listed in t.cached_results, and marked as cached in the
+# summary and in the JUnit report.
+#
+# Results are not cached when the test case caused a framework failure,
+# or when the test run is stopped. Environment variables are not part of
+# the hash, and the cache is never used with --accept.
+
+result_cache = None
+result_cache_fingerprint = None
+
+def initResultCache():
+    global result_cache, result_cache_fingerprint
+    result_cache_fingerprint = run_fingerprint(
+                                   strip_quotes(config.compiler),
+                                   getStdout([config.compiler, '--info']),
+                                   config.libdir,
+                                   os.path.dirname(config.package_conf_cache_file),
+                                   config.top)
+    result_cache = ResultCache(os.path.join(config.cache_dir, 'results'))
+
+def resultCacheKey(name, way, func, args, files):
+    opts = getTestOpts()
+    return hash_value([
+        result_cache_fingerprint,
+        name,
+        way,
+        config.way_flags.get(way),
+        config.way_rts_flags.get(way),
+        # The test directory changes between runs with LOCAL=0.
+        dict((field, value) for (field, value) in opts.items()
+                            if field != 'testdir'),
+        func,
+        args,
+        [(f, hash_path(in_srcdir(f))) for f in sorted(files)],
+        hash_path(in_srcdir('Makefile')),
+        [(f, hash_file(in_srcdir(f)))
+         for f in srcdirIndex(opts.srcdir).names if f.endswith('.T')],
+        config.test_env,
+        config.allowed_perf_changes.get(name),
+    ])
+
+def storeCachedResult(key, name, way, result, metrics, framework_failures):
+    if stopping() or not isinstance(result, dict) \
+       or result.get('passFail') not in ['pass', 'fail']:
+        return
+    if any(failure[1] == name and failure[2] == way
+           for failure in framework_failures):
+        return
+
+    result_cache.store(key, {
+        'result': dict((field, value) for (field, value) in result.items()
+                                      if field in ['passFail', 'reason', 'tag']),
+        'metrics': [(change, stat) for (change, stat) in metrics
+                                   if stat.test == name and stat.way == way],
+        })
+
+# Note [Phase timings]
+#
+# To find out where the time of a test run goes, do_test records for every
+# test case how much wall time, and how much CPU time of child processes
+# (compilers, test programs, diff, ...) it spends in each of its phases:
+#
+#   cleanup  removing the test directory, before the test and after its
+#            last way
+#   setup    creating the test directory, and linking the source files
+#   pre_cmd  running the pre_cmd
+#   compile  compiling (simple_build)
+#   run      whatever else the test function does, usually running the
+#            program or command
+#   compare  comparing outputs (compare_outputs)
+#
+# Phases nest: the compile and compare phases happen inside of the run
+# phase, and their wall time is not counted towards it. The CPU time of a
+# command is measured by runCmd, and counted towards the innermost phase.
+#
+# The timings end up in t.phase_times, and are saved in
+# <cache_dir>/phases.json at the end of a test run, where
+# `runtests.py --timing-report` finds them. They are stored by the source
+# directory of the test relative to the top of the testsuite, and the
+# name of the test (see phaseTimesKey), which stay the same between runs,
+# unlike the test directory (which is in a new temporary directory every
+# run with LOCAL=0).
+
+def phaseTimesKey(name, opts):
+    srcdir = os.path.relpath(opts.srcdir, config.top)
+    return PurePath(srcdir, name).as_posix()
+
+@contextmanager
+def phase(name):
+    times = getattr(phases_local, 'times', None)
+    if times is None:
+        yield
+        return
+
+    outer = phases_local.current
+    phases_local.current = name
+    times.setdefault(name, [0.0, 0.0])
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start_time
+        times[name][0] += elapsed
+        if outer is not None:
+            times[outer][0] -= elapsed
+        phases_local.current = outer
+
+# Count CPU time spent by a child process towards the current phase.
+def add_phase_cpu_time(seconds):
+    times = getattr(phases_local, 'times', None)
+    if times is not None and phases_local.current is not None:
+        times[phases_local.current][1] += seconds
+
+# Note [Test directory templates]
+#
+# A test that is run in several ways gets a fresh test directory for
+# every way. Setting it up (see setup_testdir) looks at every file that
+# is copied into it in the source directory, and walks the directories
+# in extra_files recursively, which is slow for big directories,
+# especially on network filesystems.
+#
+# So the test directory of the first way to be set up is saved as a
+# template (next to the test directory), and the test directories of the
+# ways started after that are cloned from it with clone_tree. That doesn't
+# look at the source directory at all: it hard links the symbolic links in
+# the template, and reflinks (or copies) the few files that are copies,
+# such as the Makefile. The template is removed after the last way (see
+# finishTest).
+#
+# The ways of a test may be set up at the same time, in different threads
+# or processes (see Note [Test cases]). So a template is saved under a
+# name of its own first, and then renamed into place: either it is there
+# as a whole, or not at all.
+
+class TestDirTemplate:
+    # testdir: the test directory of the test (not of one of its cases).
+    def __init__(self, testdir):
+        self.path = testdir[:-len(testdir_suffix)] + '.template' + testdir_suffix
+
+    def ready(self):
+        return os.path.isdir(self.path)
+
+    # Save the given test directory as the template.
+    def save(self, testdir):
+        tmp_path = '{0}.{1}.{2}{3}'.format(self.path[:-len(testdir_suffix)],
+                       os.getpid(), threading.get_ident(), testdir_suffix)
+        clone_tree(testdir, tmp_path)
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # Another way saved it first.
+            removeDir(tmp_path)
+
+    def remove(self):
+        removeDir(self.path)
+
+def setup_testdir(name, way, func, files):
+    opts = getTestOpts()
+
+    makeTestDir(opts.testdir)
 
     # Link all source files for this test into a new directory in
     # /tmp, and run the test in that directory. This makes it
@@ -931,53 +1788,6 @@ def do_test(name, way, func, args, files):
                 with io.open(dst_makefile, 'w', encoding='utf8') as dst:
                     dst.write(makefile)
 
-    if opts.pre_cmd:
-        exit_code = runCmd('cd "{0}" && {1}'.format(opts.testdir, override_options(opts.pre_cmd)),
-                           stderr = subprocess.STDOUT,
-                           print_output = config.verbose >= 3)
-
-        # If user used expect_broken then don't record failures of pre_cmd
-        if exit_code != 0 and opts.expect not in ['fail']:
-            framework_fail(name, way, 'pre_cmd failed: {0}'.format(exit_code))
-            if_verbose(1, '** pre_cmd was "{0}".'.format(override_options(opts.pre_cmd)))
-
-    result = func(*[name,way] + args)
-
-    if opts.expect not in ['pass', 'fail', 'missing-lib']:
-        framework_fail(name, way, 'bad expected ' + opts.expect)
-
-    try:
-        passFail = result['passFail']
-    except (KeyError, TypeError):
-        passFail = 'No passFail found'
-
-    directory = re.sub('^\\.[/\\\\]', '', opts.testdir)
-
-    if passFail == 'pass':
-        if _expect_pass(way):
-            t.expected_passes.append((directory, name, way))
-            t.n_expected_passes += 1
-        else:
-            if_verbose(1, '*** unexpected pass for %s' % full_name)
-            t.unexpected_passes.append((directory, name, 'unexpected', way))
-    elif passFail == 'fail':
-        if _expect_pass(way):
-            reason = result['reason']
-            tag = result.get('tag')
-            if tag == 'stat':
-                if_verbose(1, '*** unexpected stat test failure for %s' % full_name)
-                t.unexpected_stat_failures.append((directory, name, reason, way))
-            else:
-                if_verbose(1, '*** unexpected failure for %s' % full_name)
-                t.unexpected_failures.append((directory, name, reason, way))
-        else:
-            if opts.expect == 'missing-lib':
-                t.missing_libs.append((directory, name, 'missing-lib', way))
-            else:
-                t.n_expected_failures += 1
-    else:
-        framework_fail(name, way, 'bad result ' + passFail)
-
 # Make is often invoked with -s, which means if it fails, we get
 # no feedback at all. This is annoying. So let's remove the option
 # if found and instead have the testsuite decide on what to do
@@ -990,19 +1800,36 @@ def override_options(pre_cmd):
 
     return pre_cmd
 
+# The test directory to report the results of the test with, see Note
+# [Test cases]. While loading .T files, that's the one of the current
+# test options.
+def testDirectory(name):
+    test = testRegistry.get(name)
+    if test is None or currentRegistration() is not None:
+        testdir = getTestOpts().testdir
+    else:
+        testdir = test.opts.testdir
+    return re.sub('^\\.[/\\\\]', '', testdir)
+
 def framework_fail(name, way, reason):
-    opts = getTestOpts()
-    directory = re.sub('^\\.[/\\\\]', '', opts.testdir)
+    directory = testDirectory(name)
     full_name = name + '(' + way + ')'
     if_verbose(1, '*** framework failure for %s %s ' % (full_name, reason))
     t.framework_failures.append((directory, name, way, reason))
+    if getattr(case_local, 'framework_failures', None) is not None:
+        case_local.framework_failures.append((directory, name, way, reason))
+    registration = currentRegistration()
+    if registration is not None:
+        registration.problems += 1
 
 def framework_warn(name, way, reason):
-    opts = getTestOpts()
-    directory = re.sub('^\\.[/\\\\]', '', opts.testdir)
+    directory = testDirectory(name)
     full_name = name + '(' + way + ')'
     if_verbose(1, '*** framework warning for %s %s ' % (full_name, reason))
     t.framework_warnings.append((directory, name, way, reason))
+    registration = currentRegistration()
+    if registration is not None:
+        registration.problems += 1
 
 def badResult(result):
     try:
@@ -1221,7 +2048,7 @@ def check_stats(name, way, stats_file, range_fields):
                         tolerance_dev,
                         config.allowed_perf_changes,
                         config.verbose >= 4)
-                t.metrics.append((change, perf_stat))
+                recordMetric((change, perf_stat))
 
             # If any metric fails then the test fails.
             # Note, the remaining metrics are still run so that
@@ -1244,6 +2071,7 @@ def extras_build( way, extra_mods, extra_hc_opts ):
 
     return {'passFail' : 'pass', 'hc_opts' : extra_hc_opts}
 
+@phase('compile')
 def simple_build(name,
                  way,
                  extra_hc_opts: str,
@@ -1305,14 +2133,15 @@ def simple_build(name,
 
     flags = ' '.join(get_compiler_flags() + config.way_flags[way])
 
-    cmd = ('cd "{opts.testdir}" && {cmd_prefix} '
+    cmd = ('{cmd_prefix} '
            '{{compiler}} {to_do} {srcname} {flags} {extra_hc_opts}'
           ).format(**locals())
 
     if filter_with != '':
         cmd = cmd + ' | ' + filter_with
 
-    exit_code = runCmd(cmd, None, stdout, stderr, opts.compile_timeout_multiplier)
+    exit_code = runCmd(cmd, None, stdout, stderr, opts.compile_timeout_multiplier,
+                       cwd=opts.testdir)
 
     if exit_code != 0 and not should_fail:
         if config.verbose >= 1 and _expect_pass(way):
@@ -1374,10 +2203,9 @@ def simple_run(name, way, prog, extra_run_opts):
     if opts.cmd_wrapper != None:
         cmd = opts.cmd_wrapper(cmd)
 
-    cmd = 'cd "{opts.testdir}" && {cmd}'.format(**locals())
-
     # run the command
-    exit_code = runCmd(cmd, stdin, stdout, stderr, opts.run_timeout_multiplier)
+    exit_code = runCmd(cmd, stdin, stdout, stderr, opts.run_timeout_multiplier,
+                       cwd=opts.testdir)
 
     # check the exit code
     if exit_code != opts.exit_code:
@@ -1455,9 +2283,8 @@ def interpreter_run(name, way, extra_hc_opts, top_mod):
     if getTestOpts().cmd_wrapper != None:
         cmd = opts.cmd_wrapper(cmd);
 
-    cmd = 'cd "{opts.testdir}" && {cmd}'.format(**locals())
-
-    exit_code = runCmd(cmd, script, stdout, stderr, opts.run_timeout_multiplier)
+    exit_code = runCmd(cmd, script, stdout, stderr, opts.run_timeout_multiplier,
+                       cwd=opts.testdir)
 
     # split the stdout into compilation/program output
     split_file(stdout, delimiter,
@@ -1595,9 +2422,9 @@ def check_hp_ok(name):
     opts = getTestOpts()
 
     # do not qualify for hp2ps because we should be in the right directory
-    hp2psCmd = 'cd "{opts.testdir}" && {{hp2ps}} {name}'.format(**locals())
+    hp2psCmd = '{{hp2ps}} {name}'.format(**locals())
 
-    hp2psResult = runCmd(hp2psCmd)
+    hp2psResult = runCmd(hp2psCmd, cwd=opts.testdir)
 
     actual_ps_path = in_testdir(name, 'ps')
 
@@ -1645,26 +2472,36 @@ def check_prof_ok(name, way):
 # new output. Returns true if output matched or was accepted, false
 # otherwise. See Note [Output comparison] for the meaning of the
 # normaliser and whitespace_normaliser parameters.
+@phase('compare')
 def compare_outputs(way, kind, normaliser, expected_file, actual_file,
                     whitespace_normaliser=lambda x:x):
 
     expected_path = in_srcdir(expected_file)
     actual_path = in_testdir(actual_file)
 
+    actual_raw = read_no_crs(actual_path)
+
     if os.path.exists(expected_path):
-        expected_str = normaliser(read_no_crs(expected_path))
+        expected_raw = read_no_crs(expected_path)
+        # See Note [Fast output comparison].
+        if expected_raw == actual_raw:
+            return True
+        (expected_str, expected_ws) = normalise_expected(
+                                          normaliser, whitespace_normaliser,
+                                          getTestOpts().keep_prof_callstacks,
+                                          expected_raw)
         # Create the .normalised file in the testdir, not in the srcdir.
         expected_normalised_file = add_suffix(expected_file, 'normalised')
         expected_normalised_path = in_testdir(expected_normalised_file)
     else:
         expected_str = ''
+        expected_ws = whitespace_normaliser(expected_str)
         expected_normalised_path = '/dev/null'
 
-    actual_raw = read_no_crs(actual_path)
     actual_str = normaliser(actual_raw)
 
     # See Note [Output comparison].
-    if whitespace_normaliser(expected_str) == whitespace_normaliser(actual_str):
+    if expected_ws == whitespace_normaliser(actual_str):
         return True
     else:
         if config.verbose >= 1 and _expect_pass(way):
@@ -1678,16 +2515,8 @@ def compare_outputs(way, kind, normaliser, expected_file, actual_file,
 
         if config.verbose >= 1 and _expect_pass(way):
             # See Note [Output comparison].
-            r = runCmd('diff -uw "{0}" "{1}"'.format(expected_normalised_path,
-                                                        actual_normalised_path),
-                        print_output=True)
-
-            # If for some reason there were no non-whitespace differences,
-            # then do a full diff
-            if r == 0:
-                r = runCmd('diff -u "{0}" "{1}"'.format(expected_normalised_path,
-                                                           actual_normalised_path),
-                           print_output=True)
+            print_diff(expected_str, actual_str,
+                       expected_normalised_path, actual_normalised_path)
 
         if config.accept and (getTestOpts().expect == 'fail' or
                               way in getTestOpts().expect_fail_for):
@@ -1706,10 +2535,12 @@ def compare_outputs(way, kind, normaliser, expected_file, actual_file,
                 if_verbose(1, 'Accepting new output.')
 
             write_file(expected_path, actual_raw)
+            invalidateSrcdirIndex(getTestOpts().srcdir)
             return True
         elif config.accept:
             if_verbose(1, 'No output. Deleting "{0}".'.format(expected_path))
             os.remove(expected_path)
+            invalidateSrcdirIndex(getTestOpts().srcdir)
             return True
         else:
             return False
@@ -1726,30 +2557,138 @@ def compare_outputs(way, kind, normaliser, expected_file, actual_file,
 #    the same `normaliser` function to the outputs, to make the diff as
 #    small as possible (only showing the actual problem). But we don't
 #    apply the `whitespace_normaliser` here, because it might completely
-#    squash all whitespace, making the diff unreadable. Instead we rely
-#    on the `diff` program to ignore whitespace changes as much as
-#    possible (#10152).
+#    squash all whitespace, making the diff unreadable. Instead we make
+#    the diff ignore whitespace changes as much as possible, like
+#    `diff -uw` (#10152). See Note [Output diffs].
+
+# Note [Output diffs]
+#
+# The diff of the normalised outputs of a failing test is made by the
+# driver itself (see textdiff.py), in the format of `diff -u`, instead of
+# by running `diff -uw`, and `diff -u` when that shows nothing: a run with
+# many failures (e.g. after a change to the pretty printer) would run
+# thousands of them. The diff is made in full (up to --diff-limit lines)
+# before it is written to stdout with a single write, so that the diffs
+# of test cases failing at the same time in other threads don't end up
+# interleaved.
+#
+# Like diff, the driver looks for a shortest diff, with the algorithm of
+# Myers, but it doesn't have the heuristics of GNU diff for picking one
+# of several shortest diffs, and moving changes to other lines. On random
+# edits of the expected stderr files, about 96% of the diffs are the same
+# as those of GNU diff; the rest show other lines as changed, which can
+# group the changes into other hunks with more or fewer lines of context
+# (up to a few lines more). For two texts with more than
+# max_shortest_diff differences (see textdiff.py), the driver falls back
+# to difflib, whose diffs can be much longer than those of diff when
+# lines repeat.
+#
+# With --diff-limit N, only the first N lines of every diff are shown,
+# then truncated_diff_marker.
+
+truncated_diff_marker = '[diff truncated after {0} lines by the testsuite driver]\n'
+
+def print_diff(expected_str, actual_str, expected_path, actual_path):
+    diff = unified_diff(expected_str, actual_str, expected_path, actual_path,
+                        ignore_whitespace=True)
+    first_line = next(diff, None)
+    if first_line is None:
+        # If for some reason there were no non-whitespace differences,
+        # then do a full diff
+        diff = unified_diff(expected_str, actual_str,
+                            expected_path, actual_path)
+    else:
+        diff = itertools.chain([first_line], diff)
+
+    lines = []
+    for (n, line) in enumerate(diff):
+        if config.diff_limit and n == config.diff_limit:
+            lines.append(truncated_diff_marker.format(n))
+            break
+        lines.append(line)
+    sys.stdout.write(''.join(lines))
+    sys.stdout.flush()
+
+# Note [Fast output comparison]
+#
+# Both outputs are normalised by the same normalisers for the same test
+# case, so when the actual output is the same text as the expected one,
+# they compare equal after normalising: most passing test cases don't
+# need to normalise anything.
+#
+# Otherwise, the expected output is normalised (and whitespace normalised)
+# once per normaliser, and remembered by normalise_expected: the ways of
+# a test compare their outputs to the same expected file, with the same
+# normalisers (join_normalisers returns the same Normaliser for the same
+# functions). Only the actual output is normalised for every way.
+#
+# This relies on the normalisers depending on nothing but the text they
+# normalise, and the keep_prof_callstacks option of the test, which
+# normalise_errmsg and normalise_output look up (see normalise_callstacks).
+# So that option is part of what normalise_expected remembers the result
+# by; a normaliser that looks at other options would get a stale result.
+#
+# The normalised expected outputs are not kept between runs: looking one
+# up on disk, by a hash of the normaliser (its code and closures, see
+# hash_value) and of the expected file, costs many times more than
+# normalising the file with the compiled normalisers (see Note [Compiled
+# normalisers]).
+
+@functools.lru_cache(maxsize=256)
+def normalise_expected(normaliser, whitespace_normaliser, keep_prof_callstacks,
+                       expected_raw):
+    expected_str = normaliser(expected_raw)
+    return (expected_str, whitespace_normaliser(expected_str))
 
 def normalise_whitespace( str ):
     # Merge contiguous whitespace characters into a single space.
     return ' '.join(str.split())
 
+# Note [Compiled normalisers]
+#
+# The outputs of every test case are normalised (see Note [Output
+# comparison]), some of them more than once, and some are large. So the
+# normalisers of the driver (normalise_errmsg and normalise_output) are
+# Normalisers (see normaliser.py), made of Rules that are compiled once:
+#
+#  * the substitutions that modify_lines applied line by line, calling a
+#    Python function for every line, are applied to the whole text
+#    instead (they can't match a line break), between join_lines and
+#    end_lines;
+#
+#  * substitutions of plain strings use str.replace;
+#
+#  * a rule whose matches all contain some string (its needle) skips the
+#    texts without it. Scanning for a string is much faster than scanning
+#    for a pattern that doesn't start with one, and most texts contain no
+#    match for most rules. For the same reason, remove_exe scans for
+#    ".exe", and then looks at the character before it.
+#
+# Combining all the rules into one alternation, to normalise in a single
+# scan, would be slower: the re module tries every alternative at every
+# position of the text.
+#
+# join_normalisers also builds a Normaliser, which applies the functions
+# one after the other.
+
 callSite_re = re.compile(r', called at (.+):[\d]+:[\d]+ in [\w\-\.]+:')
 
+def normalise_callsite(m):
+    location = normalise_slashes_(m.group(1))
+    return ', called at {0}:<line>:<column> in <package-id>:'.format(location)
+
+prof_callstack_re = re.compile(r'CallStack \(from -prof\):(\n  .*)*\n?')
+
 def normalise_callstacks(s):
     opts = getTestOpts()
-    def repl(matches):
-        location = matches.group(1)
-        location = normalise_slashes_(location)
-        return ', called at {0}:<line>:<column> in <package-id>:'.format(location)
     # Ignore line number differences in call stacks (#10834).
-    s = re.sub(callSite_re, repl, s)
+    s = re.sub(callSite_re, normalise_callsite, s)
     # Ignore the change in how we identify implicit call-stacks
     s = s.replace('from ImplicitParams', 'from HasCallStack')
     if not opts.keep_prof_callstacks:
         # Don't output prof callstacks. Test output should be
         # independent from the WAY we run the test.
-        s = re.sub(r'CallStack \(from -prof\):(\n  .*)*\n?', '', s)
+        s = re.sub(prof_callstack_re, '', s)
     return s
 
 tyCon_re = re.compile(r'TyCon\s*\d+L?\#\#\s*\d+L?\#\#\s*', flags=re.MULTILINE)
@@ -1758,54 +2697,99 @@ def normalise_type_reps(str):
     """ Normalise out fingerprints from Typeable TyCon representations """
     return re.sub(tyCon_re, 'TyCon FINGERPRINT FINGERPRINT ', str)
 
-def normalise_errmsg( str ):
-    """Normalise error-messages emitted via stderr"""
-    # IBM AIX's `ld` is a bit chatty
-    if opsys('aix'):
-        str = str.replace('ld: 0706-027 The -x flag is ignored.\n', '')
+# The rules of normalise_callstacks and normalise_type_reps.
+def callstack_rules(keep_prof_callstacks):
+    return [
+        Rule(callSite_re, normalise_callsite, needle=', called at '),
+        Rule('from ImplicitParams', 'from HasCallStack'),
+    ] + ([] if keep_prof_callstacks else [
+        Rule(prof_callstack_re, '', needle='CallStack (from -prof):'),
+    ]) + [
+        Rule(tyCon_re, 'TyCon FINGERPRINT FINGERPRINT ', needle='TyCon'),
+    ]
+
+# The rules of normalise_errmsg and normalise_output for the lines: the
+# two modify_lines passes they replace.
+line_rules = [
     # remove " error:" and lower-case " Warning:" to make patch for
     # trac issue #10021 smaller
-    str = modify_lines(str, lambda l: re.sub(' error:', '', l))
-    str = modify_lines(str, lambda l: re.sub(' Warning:', ' warning:', l))
-    str = normalise_callstacks(str)
-    str = normalise_type_reps(str)
-
-    # If somefile ends in ".exe" or ".exe:", zap ".exe" (for Windows)
-    #    the colon is there because it appears in error messages; this
-    #    hacky solution is used in place of more sophisticated filename
-    #    mangling
-    str = re.sub('([^\\s])\\.exe', '\\1', str)
-
-    # normalise slashes, minimise Windows/Unix filename differences
-    str = re.sub('\\\\', '/', str)
-
-    # The inplace ghc's are called ghc-stage[123] to avoid filename
-    # collisions, so we need to normalise that to just "ghc"
-    str = re.sub('ghc-stage[123]', 'ghc', str)
-
-    # Error messages sometimes contain integer implementation package
-    str = re.sub('integer-(gmp|simple)-[0-9.]+', 'integer-<IMPL>-<VERSION>', str)
-
-    # Error messages sometimes contain this blurb which can vary
-    # spuriously depending upon build configuration (e.g. based on integer
-    # backend)
-    str = re.sub('...plus ([a-z]+|[0-9]+) instances involving out-of-scope types',
-                 '...plus N instances involving out-of-scope types', str)
-
-    # Also filter out bullet characters.  This is because bullets are used to
-    # separate error sections, and tests shouldn't be sensitive to how the
-    # the division happens.
-    bullet = '•'.encode('utf8') if isinstance(str, bytes) else '•'
-    str = str.replace(bullet, '')
-
+    join_lines,
+    Rule(' error:', ''),
+    end_lines,
+    join_lines,
+    Rule(' Warning:', ' warning:'),
+    end_lines,
+]
+
+exe_re = re.compile('\\.exe')
+
+# Remove a .exe extension (for Windows): the same as
+# re.sub('([^\\s])\\.exe', '\\1', s), but much faster, as it scans for a
+# string instead of a pattern that starts with a character class.
+def remove_exe(s):
+    parts = []
+    start = 0
+    for m in exe_re.finditer(s):
+        # The character before the .exe, if re.sub wouldn't have taken
+        # it already as part of the previous match.
+        if m.start() > start and not s[m.start() - 1].isspace():
+            parts.append(s[start:m.start()])
+            start = m.end()
+    parts.append(s[start:])
+    return ''.join(parts)
+
+def errmsg_normaliser(keep_prof_callstacks):
+    steps = []
+    # IBM AIX's `ld` is a bit chatty
+    if opsys('aix'):
+        steps.append(Rule('ld: 0706-027 The -x flag is ignored.\n', ''))
+    steps += line_rules + callstack_rules(keep_prof_callstacks) + [
+        # If somefile ends in ".exe" or ".exe:", zap ".exe" (for Windows)
+        #    the colon is there because it appears in error messages; this
+        #    hacky solution is used in place of more sophisticated filename
+        #    mangling
+        remove_exe,
+
+        # normalise slashes, minimise Windows/Unix filename differences
+        Rule('\\\\', '/', needle='\\'),
+
+        # The inplace ghc's are called ghc-stage[123] to avoid filename
+        # collisions, so we need to normalise that to just "ghc"
+        Rule('ghc-stage[123]', 'ghc', needle='ghc-stage'),
+
+        # Error messages sometimes contain integer implementation package
+        Rule('integer-(gmp|simple)-[0-9.]+', 'integer-<IMPL>-<VERSION>',
+             needle='integer-'),
+
+        # Error messages sometimes contain this blurb which can vary
+        # spuriously depending upon build configuration (e.g. based on integer
+        # backend)
+        Rule('...plus ([a-z]+|[0-9]+) instances involving out-of-scope types',
+             '...plus N instances involving out-of-scope types',
+             needle=' instances involving out-of-scope types'),
+
+        # Also filter out bullet characters.  This is because bullets are used to
+        # separate error sections, and tests shouldn't be sensitive to how the
+        # the division happens.
+        Rule('•', ''),
+    ]
     # Windows only, this is a bug in hsc2hs but it is preventing
     # stable output for the testsuite. See Trac #9775. For now we filter out this
     # warning message to get clean output.
     if config.msys:
-        str = re.sub('Failed to remove file (.*); error= (.*)$', '', str)
-        str = re.sub('DeleteFile "(.+)": permission denied \(Access is denied\.\)(.*)$', '', str)
+        steps += [Rule('Failed to remove file (.*); error= (.*)$', ''),
+                  Rule('DeleteFile "(.+)": permission denied \(Access is denied\.\)(.*)$', '')]
+    return Normaliser(steps)
 
-    return str
+# {keep_prof_callstacks: Normaliser}
+errmsg_normalisers = {}
+
+def normalise_errmsg( str ):
+    """Normalise error-messages emitted via stderr"""
+    keep = getTestOpts().keep_prof_callstacks
+    if keep not in errmsg_normalisers:
+        errmsg_normalisers[keep] = errmsg_normaliser(keep)
+    return errmsg_normalisers[keep](str)
 
 # normalise a .prof file, so that we can reasonably compare it against
 # a sample.  This doesn't compare any of the actual profiling data,
@@ -1865,17 +2849,21 @@ def normalise_exe_( str ):
     str = re.sub('\.exe', '', str)
     return str
 
+def output_normaliser(keep_prof_callstacks):
+    return Normaliser(line_rules + [
+        # Remove a .exe extension (for Windows)
+        # This can occur in error messages generated by the program.
+        remove_exe,
+    ] + callstack_rules(keep_prof_callstacks))
+
+# {keep_prof_callstacks: Normaliser}
+output_normalisers = {}
+
 def normalise_output( str ):
-    # remove " error:" and lower-case " Warning:" to make patch for
-    # trac issue #10021 smaller
-    str = modify_lines(str, lambda l: re.sub(' error:', '', l))
-    str = modify_lines(str, lambda l: re.sub(' Warning:', ' warning:', l))
-    # Remove a .exe extension (for Windows)
-    # This can occur in error messages generated by the program.
-    str = re.sub('([^\\s])\\.exe', '\\1', str)
-    str = normalise_callstacks(str)
-    str = normalise_type_reps(str)
-    return str
+    keep = getTestOpts().keep_prof_callstacks
+    if keep not in output_normalisers:
+        output_normalisers[keep] = output_normaliser(keep)
+    return output_normalisers[keep](str)
 
 def normalise_asm( str ):
     lines = str.split('\n')
@@ -1909,59 +2897,322 @@ def dump_file(f):
     except Exception:
         print('')
 
-def runCmd(cmd, stdin=None, stdout=None, stderr=None, timeout_multiplier=1.0, print_output=False):
+def runCmd(cmd, stdin=None, stdout=None, stderr=None, timeout_multiplier=1.0, print_output=False, cwd=None):
     timeout_prog = strip_quotes(config.timeout_prog)
     timeout = str(int(ceil(config.timeout * timeout_multiplier)))
 
     # Format cmd using config. Example: cmd='{hpc} report A.tix'
     cmd = cmd.format(**config.__dict__)
-    if_verbose(3, cmd + ('< ' + os.path.basename(stdin) if stdin else ''))
+    if_verbose(3, ('cd "{0}" && '.format(cwd) if cwd else '') + cmd
+                  + ('< ' + os.path.basename(stdin) if stdin else ''))
 
-    stdin_file = io.open(stdin, 'rb') if stdin else None
-    stdout_buffer = b''
-    stderr_buffer = b''
-
-    hStdErr = subprocess.PIPE
-    if stderr is subprocess.STDOUT:
-        hStdErr = subprocess.STDOUT
-
-    try:
+    if not run_directly:
         # cmd is a complex command in Bourne-shell syntax
         # e.g (cd . && 'C:/users/simonpj/HEAD/inplace/bin/ghc-stage2' ...etc)
         # Hence it must ultimately be run by a Bourne shell. It's timeout's job
         # to invoke the Bourne shell
+        if cwd:
+            cmd = 'cd "{0}" && {1}'.format(cwd, cmd)
+        returncode = runCmdSubprocess([timeout_prog, timeout, cmd], None, None,
+                                      stdin, stdout, stderr, print_output)
+    else:
+        returncode = runCmdSubprocess(cmd, cwd, int(timeout),
+                                      stdin, stdout, stderr, print_output)
 
-        r = subprocess.Popen([timeout_prog, timeout, cmd],
-                             stdin=stdin_file,
-                             stdout=subprocess.PIPE,
-                             stderr=hStdErr,
-                             env=ghc_env)
-
-        stdout_buffer, stderr_buffer = r.communicate()
-    finally:
-        if stdin_file:
-            stdin_file.close()
-        if config.verbose >= 1 and print_output:
-            if stdout_buffer:
-                sys.stdout.buffer.write(stdout_buffer)
-            if stderr_buffer:
-                sys.stderr.buffer.write(stderr_buffer)
-
-        if stdout:
-            with io.open(stdout, 'wb') as f:
-                f.write(stdout_buffer)
-        if stderr:
-            if stderr is not subprocess.STDOUT:
-                with io.open(stderr, 'wb') as f:
-                    f.write(stderr_buffer)
-
-    if r.returncode == 98:
+    if returncode == 98:
         # The python timeout program uses 98 to signal that ^C was pressed
         stopNow()
-    if r.returncode == 99 and getTestOpts().exit_code != 99:
+    if returncode == 99 and getTestOpts().exit_code != 99:
         # Only print a message when timeout killed the process unexpectedly.
         if_verbose(1, 'Timeout happened...killed process "{0}"...\n'.format(cmd))
-    return r.returncode
+    return returncode
+
+# Note [Running commands]
+#
+# runCmd runs commands in Bourne-shell syntax. On Windows, it runs them
+# with the timeout program, which runs /bin/sh -c cmd, and kills it when
+# it takes too long.
+#
+# Elsewhere, running a Python interpreter (timeout.py) and a shell for
+# every command is too expensive, so the driver runs the commands itself
+# (run_directly):
+#
+#  * In the directory given with cwd, instead of a `cd dir && cmd` prefix.
+#
+#  * Without a shell, unless the command uses shell syntax (see
+#    commandArgs), or isn't a program (e.g. a shell builtin).
+#
+#  * In a new process group (in the same session), like the timeout
+#    program does. So ^C in the terminal doesn't reach the command, and
+#    the driver kills all running commands itself (see stopCommands).
+#    They then return 98, like the timeout program.
+#
+#  * When the command takes too long, the driver kills its process group,
+#    and returns 99, like the timeout program. Like the shell and the
+#    timeout program, it returns 128 + n when the command is killed by
+#    signal n.
+#
+#  * A process group is only killed while the command is in
+#    running_commands, and the driver removes it from there when it has
+#    exited but before it is reaped (see waitForExit): until then, no
+#    other process can get its process (group) id.
+
+run_directly = hasattr(os, 'killpg')
+
+running_commands = set()
+running_commands_lock = threading.Lock()
+commands_stopped = False
+
+# Characters that have a meaning in the shell (other than quotes), and
+# variable assignments (`VAR=value cmd`).
+shell_syntax_re = re.compile(r'[|&;<>()$`\\*?[\]#~{}!\n]')
+assignment_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*=')
+
+# The program and arguments to run a command with. See Note [Running
+# commands].
+def commandArgs(cmd):
+    if not shell_syntax_re.search(cmd):
+        args = shlex.split(cmd)
+        if args and not assignment_re.match(args[0]):
+            return args
+    return shellArgs(cmd)
+
+def shellArgs(cmd):
+    return ['/bin/sh', '-c', cmd]
+
+# Run a command, given as arguments for Popen, or as a string for
+# commandArgs. Without a timeout, the command must handle timeouts itself
+# (i.e. it is the timeout program).
+def runCmdSubprocess(cmd, cwd, timeout, stdin, stdout, stderr, print_output):
+    timed_out = []
+    print_output = config.verbose >= 1 and print_output
+    limit = outputLimit()
+
+    with contextlib.ExitStack() as files:
+        stdin_file = files.enter_context(io.open(stdin, 'rb')) if stdin else None
+        # See Note [Command output].
+        out = files.enter_context(CommandOutput(stdout, print_output, limit))
+        if stderr is subprocess.STDOUT:
+            err = None
+            hStdErr = subprocess.STDOUT
+        else:
+            err = files.enter_context(CommandOutput(stderr, print_output, limit))
+            hStdErr = err.handle()
+        if jobserver is not None:
+            # See Note [Jobserver].
+            files.enter_context(jobserver.command())
+
+        def popen(args):
+            return subprocess.Popen(args,
+                                    cwd=cwd,
+                                    stdin=stdin_file,
+                                    stdout=out.handle(),
+                                    stderr=hStdErr,
+                                    env=ghc_env,
+                                    pass_fds=command_fds,
+                                    **(newProcessGroup() if timeout is not None
+                                       else {}))
+
+        if timeout is None:
+            r = popen(cmd)
+        else:
+            args = commandArgs(cmd)
+            try:
+                r = popen(args)
+            except OSError:
+                # Leave it to the shell to find or report the program.
+                r = popen(shellArgs(cmd))
+            with running_commands_lock:
+                running_commands.add(r.pid)
+
+            def kill():
+                with running_commands_lock:
+                    if r.pid in running_commands:
+                        timed_out.append(True)
+                        killProcessGroup(r.pid)
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            communicate(r, {r.stdout: out, r.stderr: err})
+        except KeyboardInterrupt:
+            # Only happens when tests run in the main thread (--threads=1).
+            stopCommands()
+            waitForExit(r.pid)
+            r.wait()
+        finally:
+            if timeout is not None:
+                timer.cancel()
+                with running_commands_lock:
+                    running_commands.discard(r.pid)
+
+        if print_output:
+            sys.stdout.flush()
+            out.print(sys.stdout.buffer)
+            if err:
+                err.print(sys.stderr.buffer)
+
+    if timeout is None:
+        return r.returncode
+    return commandResult(r.returncode, bool(timed_out))
+
+# The result of a command run directly, like the timeout program would
+# return it. See Note [Running commands].
+def commandResult(returncode, timed_out):
+    if timed_out:
+        return 99
+    elif commands_stopped:
+        return 98
+    elif returncode < 0:
+        return 128 - returncode
+    else:
+        return returncode
+
+# The arguments of Popen for a new process group. See Note [Running
+# commands].
+def newProcessGroup():
+    if sys.version_info >= (3, 11):
+        return {'process_group': 0}
+    return {'preexec_fn': os.setpgrp}
+
+# Wait until a command has exited, without reaping it, and stop killing
+# it. See Note [Running commands].
+def waitForExit(pid):
+    if hasattr(os, 'waitid'):
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+    with running_commands_lock:
+        running_commands.discard(pid)
+
+def killProcessGroup(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+# Stop all tests after ^C, by killing the commands that are running. With
+# --executor=process, the worker processes do this when they are
+# terminated. See Note [Running commands].
+def stopCommands():
+    if not run_directly:
+        # The timeout program gets the ^C itself.
+        return
+
+    stopNow()
+    killRunningCommands()
+    stopProcessPool()
+
+def killRunningCommands():
+    global commands_stopped
+    commands_stopped = True
+    with running_commands_lock:
+        for pid in running_commands:
+            killProcessGroup(pid)
+
+# Like Popen.communicate (without input), but also count the CPU time of the
+# process and of its children towards the current phase. See Note [Phase
+# timings].
+def communicate(r, outputs):
+    if not hasattr(os, 'wait4'):
+        # Windows: we can't get the CPU time.
+        for (output, data) in zip([r.stdout, r.stderr], r.communicate()):
+            if output:
+                outputs[output].write(data)
+        return
+
+    with selectors.DefaultSelector() as selector:
+        for f in [r.stdout, r.stderr]:
+            if f:
+                selector.register(f, selectors.EVENT_READ)
+        while selector.get_map():
+            for (key, _) in selector.select():
+                if not outputs[key.fileobj].copy_from(key.fd):
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+    # Reap the process ourselves, Popen.wait doesn't give us its resource
+    # usage.
+    waitForExit(r.pid)
+    (_, status, rusage) = os.wait4(r.pid, 0)
+    if os.WIFSIGNALED(status):
+        r.returncode = -os.WTERMSIG(status)
+    else:
+        r.returncode = os.WEXITSTATUS(status)
+    add_phase_cpu_time(rusage.ru_utime + rusage.ru_stime)
+
+# Note [Command output]
+#
+# The output of a command can be huge, e.g. when a test goes into a loop
+# printing something. So runCmd doesn't collect it in memory, but writes
+# it to its output file (or to a temporary file, if it has to print it
+# and there is no output file) as it comes in.
+#
+# The output is cut off after opts.output_limit bytes (or
+# config.output_limit, --output-limit, if the test doesn't set one; 0
+# means no limit), and then ends with truncated_output_marker. The rest is
+# discarded.
+
+truncated_output_marker = '\n[output truncated after {0} bytes by the testsuite driver]\n'
+
+class CommandOutput:
+    def __init__(self, path, keep, limit):
+        if path:
+            self.file = io.open(path, 'w+b', buffering=0)
+        elif keep:
+            self.file = tempfile.TemporaryFile(buffering=0)
+        else:
+            self.file = None
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+
+    # What to connect the output of the command to.
+    def handle(self):
+        return subprocess.PIPE if self.file else subprocess.DEVNULL
+
+    def write(self, data):
+        if self.limit and self.size + len(data) > self.limit:
+            data = data[:self.limit - self.size]
+            self.truncated = True
+        self.file.write(data)
+        self.size += len(data)
+
+    # Copy what can be read from fd, returns False at the end of the output.
+    def copy_from(self, fd):
+        room = self.limit - self.size if self.limit else 65536
+        if room > 0 and hasattr(os, 'splice'):
+            # Doesn't even copy the output into the driver.
+            n = os.splice(fd, self.file.fileno(), min(room, 65536))
+            self.size += n
+            return n > 0
+
+        data = os.read(fd, 65536)
+        self.write(data)
+        return bool(data)
+
+    def close(self):
+        if self.file:
+            if self.truncated:
+                self.file.write(truncated_output_marker.format(self.limit)
+                                                       .encode('utf8'))
+            self.file.close()
+
+    def print(self, to):
+        if self.file:
+            self.file.seek(0)
+            shutil.copyfileobj(self.file, to)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def outputLimit():
+    opts = getattr(testopts_local, 'x', None)
+    if opts and opts.output_limit is not None:
+        return opts.output_limit
+    return config.output_limit
 
 # -----------------------------------------------------------------------------
 # checking if ghostscript is available for checking the output of hp2ps
@@ -2027,16 +3278,41 @@ def in_srcdir(name, suffix=''):
 #
 def find_expected_file(name, suff):
     basename = add_suffix(name, suff)
+    return srcdirIndex(getTestOpts().srcdir).variant(basename) or basename
 
-    files = [basename + ws + plat
-             for plat in ['-' + config.platform, '-' + config.os, '']
-             for ws in ['-ws-' + config.wordsize, '']]
-
-    for f in files:
-        if os.path.exists(in_srcdir(f)):
-            return f
-
-    return basename
+# Note [Source directory index]
+#
+# Hundreds of tests can share a source directory, and every test lists
+# it to find its files, and looks for up to six variants of every
+# expected output file (see find_expected_file). That is a lot of system
+# calls, which are slow on network filesystems. So every source directory
+# is only listed once, and the lookups are done in a DirectoryIndex.
+#
+# The driver itself only changes source directories when accepting new
+# output, after which the index of the directory is made again.
+
+srcdir_indexes = {}
+srcdir_indexes_lock = threading.Lock()
+
+def srcdirIndex(srcdir):
+    index = srcdir_indexes.get(srcdir)
+    if index is None:
+        with srcdir_indexes_lock:
+            index = srcdir_indexes.get(srcdir)
+            if index is None:
+                index = DirectoryIndex(srcdir,
+                    ['-ws-' + config.wordsize + '-' + config.platform,
+                     '-' + config.platform,
+                     '-ws-' + config.wordsize + '-' + config.os,
+                     '-' + config.os,
+                     '-ws-' + config.wordsize,
+                     ''])
+                srcdir_indexes[srcdir] = index
+    return index
+
+def invalidateSrcdirIndex(srcdir):
+    with srcdir_indexes_lock:
+        srcdir_indexes.pop(srcdir, None)
 
 if config.msys:
     import stat
@@ -2081,9 +3357,164 @@ if config.msys:
                             % (testdir, exception))
 else:
     def cleanup():
-        testdir = getTestOpts().testdir
-        if os.path.exists(testdir):
-            shutil.rmtree(testdir, ignore_errors=False)
+        removeDir(getTestOpts().testdir)
+
+# Note [Background cleanup]
+#
+# Removing a test directory (before every way of a test, and after the
+# last) can take a while, e.g. with many .hi, .o or profiling files in
+# it. So unless --no-background-cleanup is given, test directories are
+# instead renamed into a trash directory next to them (called .trash.run,
+# so that it is ignored like test directories), and removed by a
+# background thread with a low priority. When the removals fall behind,
+# removeDir waits, so the trash can't take up more and more space. At the
+# end of the run, finishBackgroundCleanup waits for the removals, and
+# removes the trash directories (and with them anything left behind by
+# worker processes, see Note [Process executor], or by earlier runs that
+# were killed).
+#
+# With --sandbox-pool=N, the background thread empties the trashed test
+# directories instead of removing them, and keeps up to N of them in
+# every trash directory for new test directories there (see
+# makeTestDir).
+#
+# On Windows, test directories are always removed right away, see the
+# cleanup above.
+
+trash_name = '.trash' + testdir_suffix
+
+class Trash:
+    def __init__(self):
+        self.pid = os.getpid()
+        # Keep at most a few test directories per thread in the trash.
+        self.queue = queue.Queue(maxsize=4 * config.threads)
+        # {trash directory: [empty directories]}
+        self.sandboxes = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.work, name='cleanup',
+                                       daemon=True)
+        self.thread.start()
+
+    def work(self):
+        # The priority of just this thread (threading.get_native_id is
+        # new in Python 3.8).
+        if sys.platform.startswith('linux') \
+           and hasattr(threading, 'get_native_id'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except OSError:
+                pass
+        while True:
+            path = self.queue.get()
+            try:
+                trash_dir = os.path.dirname(path)
+                with self.lock:
+                    sandboxes = self.sandboxes[trash_dir]
+                    if path in sandboxes:
+                        # Trashed again while it was in the pool: it must
+                        # not be handed out with whatever is in it now.
+                        sandboxes.remove(path)
+                        keep = False
+                    else:
+                        keep = len(sandboxes) < config.sandbox_pool
+                if keep:
+                    emptyDir(path)
+                    with self.lock:
+                        self.sandboxes[trash_dir].append(path)
+                else:
+                    shutil.rmtree(path, ignore_errors=True)
+            except Exception:
+                # Whatever happens, the thread must go on: removeDir and
+                # finishBackgroundCleanup wait for it.
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                self.queue.task_done()
+
+    # Queue a trashed directory for removal. Returns False if the thread
+    # is gone (it never should be), so it doesn't wait for it forever.
+    def put(self, path):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(path, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Wait until the queued directories are removed, or the thread is gone.
+    def join(self):
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.thread.is_alive():
+                self.queue.all_tasks_done.wait(1)
+
+    def sandbox(self, trash_dir):
+        with self.lock:
+            sandboxes = self.sandboxes.get(trash_dir)
+            return sandboxes.pop() if sandboxes else None
+
+trash = None
+trash_lock = threading.Lock()
+
+def getTrash():
+    global trash
+    with trash_lock:
+        # A worker process doesn't have the thread of its parent.
+        if trash is None or trash.pid != os.getpid():
+            trash = Trash()
+        return trash
+
+def emptyDir(path):
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+def trashDir(path):
+    return os.path.join(os.path.dirname(path), trash_name)
+
+# Remove a directory. See Note [Background cleanup].
+def removeDir(path):
+    if not os.path.exists(path):
+        return
+    if config.background_cleanup:
+        trash_dir = trashDir(path)
+        try:
+            os.makedirs(trash_dir, exist_ok=True)
+            # A new name, which no other trashed directory (in particular,
+            # no emptied one in the pool) has. The rename replaces the
+            # empty directory that mkdtemp creates.
+            trashed = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                                       dir=trash_dir)
+            os.rename(path, trashed)
+        except OSError:
+            pass
+        else:
+            if getTrash().put(trashed):
+                return
+            path = trashed
+    shutil.rmtree(path, ignore_errors=False)
+
+# Create a test directory, from an empty one in the trash if there is one.
+def makeTestDir(path):
+    if config.background_cleanup and config.sandbox_pool:
+        sandbox = getTrash().sandbox(trashDir(path))
+        if sandbox:
+            try:
+                os.rename(sandbox, path)
+                return
+            except OSError:
+                pass
+    os.makedirs(path)
+
+def finishBackgroundCleanup():
+    if trash is not None and trash.pid == os.getpid():
+        trash.join()
+    if config.background_cleanup:
+        for trash_dir in set(trashDir(test.opts.testdir)
+                             for test in testRegistry.values()):
+            if os.path.exists(trash_dir):
+                shutil.rmtree(trash_dir, ignore_errors=True)
 
 
 # -----------------------------------------------------------------------------
@@ -2125,7 +3556,8 @@ def summary(t, file, short=False, color=False):
     file.write(colorize('SUMMARY') + ' for test run started at '
                + time.strftime("%c %Z", t.start_time) + '\n'
                + str(datetime.timedelta(seconds=
-                    round(time.time() - time.mktime(t.start_time)))).rjust(8)
+                    round((t.end_time or time.time())
+                          - time.mktime(t.start_time)))).rjust(8)
                + ' spent to go through\n'
                + repr(t.total_tests).rjust(8)
                + ' total tests, which gave rise to\n'
@@ -2133,6 +3565,9 @@ def summary(t, file, short=False, color=False):
                + ' test cases, of which\n'
                + repr(t.n_tests_skipped).rjust(8)
                + ' were skipped\n'
+               + (repr(len(t.cached_results)).rjust(8)
+                  + ' were replayed from the result cache\n'
+                  if t.cached_results else '')
                + '\n'
                + repr(len(t.missing_libs)).rjust(8)
                + ' had missing libraries\n'
@@ -2153,17 +3588,20 @@ def summary(t, file, short=False, color=False):
                + ' unexpected stat failures\n'
                + '\n')
 
+    # See Note [Result cache].
+    cached = set((name, way) for (_, name, way) in t.cached_results)
+
     if t.unexpected_passes:
         file.write('Unexpected passes:\n')
-        printTestInfosSummary(file, t.unexpected_passes)
+        printTestInfosSummary(file, t.unexpected_passes, cached)
 
     if t.unexpected_failures:
         file.write('Unexpected failures:\n')
-        printTestInfosSummary(file, t.unexpected_failures)
+        printTestInfosSummary(file, t.unexpected_failures, cached)
 
     if t.unexpected_stat_failures:
         file.write('Unexpected stat failures:\n')
-        printTestInfosSummary(file, t.unexpected_stat_failures)
+        printTestInfosSummary(file, t.unexpected_stat_failures, cached)
 
     if t.framework_failures:
         file.write('Framework failures:\n')
@@ -2185,11 +3623,12 @@ def printUnexpectedTests(file, testInfoss):
         file.write('TEST="' + ' '.join(sorted(unexpected)) + '"\n')
         file.write('\n')
 
-def printTestInfosSummary(file, testInfos):
+def printTestInfosSummary(file, testInfos, cached=set()):
     maxDirLen = max(len(directory) for (directory, _, _, _) in testInfos)
     for (directory, name, reason, way) in testInfos:
         directory = directory.ljust(maxDirLen)
-        file.write('   {directory}  {name} [{reason}] ({way})\n'.format(**locals()))
+        file.write('   {directory}  {name} [{reason}] ({way})'.format(**locals())
+                   + (' (cached)' if (name, way) in cached else '') + '\n')
     file.write('\n')
 
 def modify_lines(s, f):
@@ -1,5 +1,10 @@
+import bisect
+import contextlib
+import errno
+import multiprocessing
 import os
 import platform
+import select
 import subprocess
 import shutil
 
@@ -54,6 +59,45 @@ def lndir(srcdir, dstdir):
             os.mkdir(dst)
             lndir(src, dst)
 
+# Copy a directory tree made by setup_testdir: symbolic links are linked
+# (or else copied) as they are, without looking at what they point to,
+# and files are cloned (reflinked) where the filesystem supports it, or
+# else copied.
+def clone_tree(src, dst):
+    os.mkdir(dst)
+    # Listed in full first, which also closes the directory (os.scandir
+    # is only a context manager from Python 3.6 on).
+    for entry in list(os.scandir(src)):
+        target = os.path.join(dst, entry.name)
+        if entry.is_symlink():
+            try:
+                os.link(entry.path, target, follow_symlinks=False)
+            except (OSError, NotImplementedError):
+                os.symlink(os.readlink(entry.path), target)
+        elif entry.is_dir():
+            clone_tree(entry.path, target)
+        else:
+            clone_file(entry.path, target)
+
+try:
+    import fcntl
+    # From linux/fs.h
+    FICLONE = 0x40049409
+except ImportError:
+    fcntl = None
+
+def clone_file(src, dst):
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            shutil.copymode(src, dst)
+            return
+        except OSError:
+            # Not supported by the filesystem (or not Linux).
+            pass
+    shutil.copy(src, dst)
+
 # On Windows, os.symlink is not defined with Python 2.7, but is in Python 3
 # when using msys2, as GHC does. Unfortunately, only Administrative users have
 # the privileges necessary to create symbolic links by default. Consequently we
@@ -83,3 +127,284 @@ class Watcher(object):
         if self.pool <= 0:
             self.evt.set()
         self.sync_lock.release()
+
+# The CPU slots and memory (in MB) that tests can use at the same time. A
+# test acquires its share before it starts, and releases it when it is
+# done. See Note [Test resources] in testlib.py.
+class ResourcePool(object):
+    def __init__(self, cpus, memory, jobserver=None):
+        self.cpus = cpus
+        self.memory = memory
+        self.free_cpus = cpus
+        self.free_memory = memory
+        self.cond = threading.Condition()
+        # A JobServer with a token for every CPU slot, or None.
+        self.jobserver = jobserver
+        # A function that tells whether the machine is low on memory, in
+        # which case no test is started while others are running.
+        self.memory_low = None
+
+    def _hold_back(self):
+        return self.memory_low is not None and self.free_cpus < self.cpus \
+               and self.memory_low()
+
+    # Wait until the resources are available, and take them. An exclusive
+    # test takes all of them. Returns what has to be released later. Must
+    # be called from one thread only, as it can hold on to some of the
+    # tokens of the jobserver while it waits for more.
+    def acquire(self, cpus, memory, exclusive=False):
+        if exclusive or cpus > self.cpus or memory > self.memory:
+            # A test that needs more than there is at all gets everything,
+            # so no other test runs next to it.
+            share = (self.cpus, self.memory)
+        else:
+            share = (cpus, memory)
+
+        with self.cond:
+            while not (self.free_cpus >= share[0] and
+                       self.free_memory >= share[1] and
+                       not self._hold_back()):
+                # Nothing tells us when memory is freed: check again
+                # every now and then.
+                self.cond.wait(1 if self.memory_low is not None else None)
+            self.free_cpus -= share[0]
+            self.free_memory -= share[1]
+
+        if self.jobserver is not None:
+            # Wait for the tokens that commands of other tests (such as
+            # make) took for their jobs.
+            self.jobserver.take(share[0])
+        return share
+
+    def release(self, share):
+        if self.jobserver is not None:
+            self.jobserver.give(share[0])
+        with self.cond:
+            self.free_cpus += share[0]
+            self.free_memory += share[1]
+            self.cond.notify_all()
+
+# A GNU make jobserver: a pipe with a token (a byte) in it for every job
+# that may run. Every job takes a token before it starts and puts it back
+# when it is done. See "Sharing Job Slots with GNU make" in the GNU make
+# manual.
+class JobServer(object):
+    def __init__(self, jobs):
+        self.jobs = jobs
+        (self.read_fd, self.write_fd) = os.pipe()
+        os.write(self.write_fd, b'+' * jobs)
+        # The tokens that the driver holds for its tests.
+        self.held = 0
+        # The number of commands running that may hold tokens, in this
+        # process or in worker processes (which share it). Its lock also
+        # guards held, and the pipe while it is refilled.
+        self.commands = multiprocessing.Value('i', 0)
+
+    # The file descriptors that commands have to inherit.
+    def fds(self):
+        return (self.read_fd, self.write_fd)
+
+    # MAKEFLAGS with the options to use this jobserver (and no other).
+    def makeflags(self, makeflags):
+        (flags, sep, variables) = makeflags.partition(' -- ')
+        flags = [flag for flag in flags.split()
+                      if not flag.startswith(('-j', '--jobserver-'))]
+        # Make before 4.2 knows --jobserver-fds, later versions prefer
+        # --jobserver-auth.
+        flags += ['-j', '--jobserver-fds={0},{1}'.format(*self.fds()),
+                  '--jobserver-auth={0},{1}'.format(*self.fds())]
+        return ' '.join(flags) + sep + variables
+
+    # Take n tokens for the driver. Must be called from one thread only.
+    def take(self, n):
+        while n > 0:
+            if not select.select([self.read_fd], [], [], 1)[0]:
+                # No token for a while, maybe because some got lost.
+                self.refill()
+                continue
+            # If a make took the token in the meantime, this waits for
+            # another one, which the test of that make gives back.
+            got = len(os.read(self.read_fd, n))
+            with self.commands.get_lock():
+                self.held += got
+            n -= got
+
+    def give(self, n):
+        with self.commands.get_lock():
+            self.held -= n
+            os.write(self.write_fd, b'+' * n)
+
+    # Run a command that may take tokens (and lose them, when it is killed
+    # before it gives them back) in the with statement.
+    @contextlib.contextmanager
+    def command(self):
+        with self.commands.get_lock():
+            self.commands.value += 1
+        try:
+            yield
+        finally:
+            with self.commands.get_lock():
+                self.commands.value -= 1
+
+    # Put back the tokens that got lost, e.g. when a make that held some
+    # was killed: all tokens but those the driver holds belong in the pipe
+    # while no command is running. Called by take.
+    def refill(self):
+        with self.commands.get_lock():
+            if self.commands.value:
+                return
+            while select.select([self.read_fd], [], [], 0)[0]:
+                os.read(self.read_fd, self.jobs)
+            os.write(self.write_fd, b'+' * (self.jobs - self.held))
+
+# The part of a RAM-backed directory (a tmpfs) that test directories may
+# take up, in bytes. Tests reserve what they are expected to write before
+# they start, and give back what they leave behind when they are done.
+class WorkArea(object):
+    def __init__(self, disk_dir, ram_dir, budget, headroom):
+        self.disk_dir = disk_dir
+        self.ram_dir = ram_dir
+        self.budget = budget
+        # How many bytes to keep free in the RAM-backed directory, for the
+        # tests that write more than they reserved.
+        self.headroom = headroom
+        self.used = 0
+        self.memory_low = None
+        self.lock = threading.Lock()
+
+    def free_space(self):
+        st = os.statvfs(self.ram_dir)
+        return st.f_bavail * st.f_frsize
+
+    # Reserve the given number of bytes. Returns the reservation, or None
+    # if there isn't enough room (or memory).
+    def reserve(self, size):
+        with self.lock:
+            if self.used + size > self.budget \
+               or self.free_space() < size + self.headroom \
+               or (self.memory_low is not None and self.memory_low()):
+                return None
+            self.used += size
+            return size
+
+    # Give back a reservation, keeping the bytes that are left behind.
+    def release(self, reservation, left):
+        with self.lock:
+            self.used += left - reservation
+
+    # The directory in the RAM-backed directory for a directory below
+    # disk_dir.
+    def relocate(self, path):
+        return os.path.join(self.ram_dir,
+                            os.path.relpath(path, self.disk_dir))
+
+# Whether a command that wrote its output into the directory (in a file
+# ending in stdout or stderr) failed because its file system was full.
+def ran_out_of_space(path):
+    message = os.strerror(errno.ENOSPC).encode('utf8')
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            if filename.endswith(('stdout', 'stderr')):
+                try:
+                    if file_contains(os.path.join(dirpath, filename), message):
+                        return True
+                except OSError:
+                    pass
+    return False
+
+# Whether the file contains the bytes, read a chunk at a time (outputs
+# can be large, see Note [Command output] in testlib.py).
+def file_contains(path, needle, chunk_size=65536):
+    with open(path, 'rb') as f:
+        tail = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return False
+            chunk = tail + chunk
+            if needle in chunk:
+                return True
+            # The start of the needle may be at the end of the chunk.
+            tail = chunk[max(0, len(chunk) - len(needle) + 1):]
+
+# The names in a directory, listed once, for looking up many names in it.
+# variant_suffixes are suffixes that files can have to give variants of
+# other files, most preferred first: variant(name) finds the most
+# preferred variant of name that exists.
+class DirectoryIndex(object):
+    def __init__(self, path, variant_suffixes):
+        self.names = sorted(os.listdir(path))
+        self.name_set = set(self.names)
+
+        # {name: (preference, variant)}
+        variants = {}
+        for variant in self.names:
+            for (preference, suffix) in enumerate(variant_suffixes):
+                if variant.endswith(suffix):
+                    name = variant[:len(variant) - len(suffix)]
+                    if (preference, variant) < variants.get(name, (len(variant_suffixes), None)):
+                        variants[name] = (preference, variant)
+        self.variants = dict((name, variant)
+                             for (name, (_, variant)) in variants.items())
+
+    def __contains__(self, name):
+        return name in self.name_set
+
+    # The names that start with the prefix, in order.
+    def starting_with(self, prefix):
+        start = bisect.bisect_left(self.names, prefix)
+        end = start
+        while end < len(self.names) and self.names[end].startswith(prefix):
+            end += 1
+        return self.names[start:end]
+
+    # The most preferred variant of the name that exists, or None.
+    def variant(self, name):
+        return self.variants.get(name)
+
+# The amount of physical memory in MB, or None if we can't tell.
+def physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2**20
+    except (AttributeError, ValueError, OSError):
+        return None
+
+# The amount of memory in MB that can be used without swapping, or None if
+# we can't tell.
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+# A writable directory on a RAM-backed filesystem, or None.
+def ram_backed_dir():
+    try:
+        with open('/proc/mounts') as f:
+            mounts = dict((fields[1], fields[2])
+                          for fields in (line.split() for line in f)
+                          if len(fields) > 2)
+    except IOError:
+        return None
+    for path in ['/dev/shm', '/run/shm']:
+        if mounts.get(path) in ('tmpfs', 'ramfs') and os.access(path, os.W_OK):
+            return path
+    return None
+
+# The number of bytes the files below a directory take up.
+def tree_size(path):
+    size = 0
+    try:
+        # See clone_tree.
+        for entry in list(os.scandir(path)):
+            if entry.is_dir(follow_symlinks=False):
+                size += tree_size(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_blocks * 512
+    except OSError:
+        pass
+    return size
@@ -0,0 +1,181 @@
+#
+# Unified diffs of two files, in the format of `diff -u` (and `diff -uw`),
+# without running diff. See Note [Output diffs] in testlib.py.
+#
+
+import difflib
+import os
+import time
+
+# The lines of a text, each ending in '\n' except maybe the last one.
+def _lines(s):
+    lines = s.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+# The header line of a file: its path and modification time, like
+# '--- a/T1.stdout\t2019-06-01 12:34:56.123456789 +0000'.
+def _header(prefix, path):
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime_ns = 0
+    mtime = time.localtime(mtime_ns // 10**9)
+    # The offset from UTC, in seconds. struct_time only has tm_gmtoff on
+    # all platforms from Python 3.6 on.
+    offset = getattr(mtime, 'tm_gmtoff', None)
+    if offset is None:
+        offset = -(time.altzone if mtime.tm_isdst > 0 else time.timezone)
+    return '{0} {1}\t{2}.{3:09d} {4}{5:02d}{6:02d}\n'.format(
+               prefix, path, time.strftime('%Y-%m-%d %H:%M:%S', mtime),
+               mtime_ns % 10**9, '-' if offset < 0 else '+',
+               abs(offset) // 3600, abs(offset) // 60 % 60)
+
+# A range of lines in a hunk header, like difflib (and diff) write it.
+def _range(start, stop):
+    length = stop - start
+    if length == 1:
+        return '{0}'.format(start + 1)
+    if length == 0:
+        # An empty range starts at the line before it.
+        return '{0},0'.format(start)
+    return '{0},{1}'.format(start + 1, length)
+
+def _line(prefix, line):
+    if line.endswith('\n'):
+        return prefix + line
+    return prefix + line + '\n\\ No newline at end of file\n'
+
+# The most differences (lines deleted or inserted) that _shortest_diff
+# looks for: it takes time quadratic in them.
+max_shortest_diff = 1000
+
+# The matching blocks of a shortest diff from the list a to the list b,
+# found with the algorithm of Myers, "An O(ND) Difference Algorithm and
+# Its Variations" (1986), which diff uses too. Like the blocks of
+# difflib.SequenceMatcher.get_matching_blocks, ending in (len(a),
+# len(b), 0). None if there are more than max_shortest_diff differences.
+def _shortest_diff(a, b):
+    (n, m) = (len(a), len(b))
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and suffix < m - prefix \
+          and a[n - 1 - suffix] == b[m - 1 - suffix]:
+        suffix += 1
+    a_mid = a[prefix:n - suffix]
+    b_mid = b[prefix:m - suffix]
+    (n_mid, m_mid) = (len(a_mid), len(b_mid))
+
+    # v[offset + k] is how far along a the furthest path with d
+    # differences gets on the diagonal k (x - y = k). trace[d] is the
+    # part of v for the diagonals -d .. d, after d differences.
+    offset = n_mid + m_mid + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(min(n_mid + m_mid, max_shortest_diff) + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n_mid and y < m_mid and a_mid[x] == b_mid[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+        trace.append(v[offset - d:offset + d + 1])
+        if v[offset + n_mid - m_mid] >= n_mid and abs(n_mid - m_mid) <= d \
+           and (d - (n_mid - m_mid)) % 2 == 0:
+            break
+    else:
+        return None
+
+    # Walk the path back from the end, collecting its diagonal runs.
+    blocks = []
+    (x, y) = (n_mid, m_mid)
+    for d in range(len(trace) - 1, 0, -1):
+        previous = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and previous[k - 1 + d - 1] < previous[k + 1 + d - 1]):
+            k_before = k + 1
+            (x_start, y_start) = (previous[k_before + d - 1],
+                                  previous[k_before + d - 1] - k_before + 1)
+        else:
+            k_before = k - 1
+            (x_start, y_start) = (previous[k_before + d - 1] + 1,
+                                  previous[k_before + d - 1] - k_before)
+        if x > x_start:
+            blocks.append((prefix + x_start, prefix + y_start, x - x_start))
+        x = previous[k_before + d - 1]
+        y = x - k_before
+    if x > 0:
+        blocks.append((prefix, prefix, x))
+    if prefix:
+        blocks.append((0, 0, prefix))
+    blocks.reverse()
+    if suffix:
+        blocks.append((n - suffix, m - suffix, suffix))
+
+    # Join adjacent blocks, as get_matching_blocks does.
+    joined = []
+    for (i, j, size) in blocks:
+        if joined and joined[-1][0] + joined[-1][2] == i \
+           and joined[-1][1] + joined[-1][2] == j:
+            joined[-1] = (joined[-1][0], joined[-1][1], joined[-1][2] + size)
+        else:
+            joined.append((i, j, size))
+    joined.append((n, m, 0))
+    return joined
+
+# A SequenceMatcher whose matching blocks are those of a shortest diff,
+# where there is one within max_shortest_diff differences: difflib looks
+# for the longest matching block first, which can make the diff much
+# longer than that of diff when lines repeat.
+class _Matcher(difflib.SequenceMatcher):
+    def get_matching_blocks(self):
+        if self.matching_blocks is None:
+            blocks = _shortest_diff(self.a, self.b)
+            if blocks is None:
+                return difflib.SequenceMatcher.get_matching_blocks(self)
+            self.matching_blocks = [difflib.Match(*block) for block in blocks]
+        return self.matching_blocks
+
+# The unified diff from the text a to the text b, line by line, with
+# three lines of context, labelled by the paths of the files they were
+# written to. With ignore_whitespace, lines are the same if they only
+# differ in whitespace, like with `diff -w`, and the context lines are
+# shown as they are in a. Empty if the texts are the same.
+def unified_diff(a, b, a_path, b_path, ignore_whitespace=False):
+    a_lines = _lines(a)
+    b_lines = _lines(b)
+    if ignore_whitespace:
+        a_keys = [''.join(line.split()) for line in a_lines]
+        b_keys = [''.join(line.split()) for line in b_lines]
+    else:
+        a_keys = a_lines
+        b_keys = b_lines
+
+    matcher = _Matcher(None, a_keys, b_keys, autojunk=False)
+    started = False
+    for group in matcher.get_grouped_opcodes(3):
+        if not started:
+            yield _header('---', a_path)
+            yield _header('+++', b_path)
+            started = True
+        (first, last) = (group[0], group[-1])
+        yield '@@ -{0} +{1} @@\n'.format(_range(first[1], last[2]),
+                                         _range(first[3], last[4]))
+        for (tag, i1, i2, j1, j2) in group:
+            if tag == 'equal':
+                for line in a_lines[i1:i2]:
+                    yield _line(' ', line)
+                continue
+            for line in a_lines[i1:i2]:
+                yield _line('-', line)
+            for line in b_lines[j1:j2]:
+                yield _line('+', line)
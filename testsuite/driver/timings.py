@@ -0,0 +1,120 @@
+#
+# Test durations recorded across test runs.
+#
+# The driver saves the wall time of every test it runs, so that the next
+# run can schedule the longest tests first, and so that tests can be
+# split into shards of similar duration. See Note [Longest tests first]
+# and Note [Sharding] in runtests.py.
+#
+# It also saves the time spent in each phase of every test case, to find
+# out where the time of a test run goes. See Note [Phase timings] in
+# testlib.py.
+#
+# And how much room the test directories of tests took up, see Note
+# [RAM-backed test directories] in testlib.py.
+#
+
+import json
+import math
+import os
+import zlib
+from collections import defaultdict
+
+# Load the durations (in seconds, by test name) stored in the given file.
+# Returns an empty dictionary if there are none.
+def load_durations(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+# Add durations (in seconds, by test name) to the ones stored in the given
+# file. Durations of tests that were not run this time are kept.
+def save_durations(path, durations):
+    all_durations = load_durations(path)
+    all_durations.update(durations)
+    _write_json(path, all_durations)
+
+# Phase timings are stored like TestRun.phase_times, and loaded and saved
+# like durations: the timings of a test replace the ones of its previous
+# run.
+load_phase_times = load_durations
+save_phase_times = save_durations
+
+# So are the sizes of the test directories of tests in a RAM-backed
+# directory (in bytes, by test name). See Note [RAM-backed test
+# directories] in testlib.py.
+load_sandbox_sizes = load_durations
+save_sandbox_sizes = save_durations
+
+def _write_json(path, value):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Write to a temporary file first, so that an interrupted run can't
+    # leave a truncated file behind.
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# Order tests by decreasing duration. Tests without a recorded duration
+# might be long too, so they come first, in their original order.
+def longest_first(tests, durations):
+    return sorted(tests, key=lambda test: -durations.get(test.name, math.inf))
+
+# Select the tests of shard index (counting from 0) out of count shards.
+#
+# Tests with a recorded duration are assigned to shards longest first,
+# each to the shard with the smallest total duration so far. Other tests
+# are assigned by a hash of their name. The assignment only depends on
+# the names of the tests and on the durations, so every machine selects
+# the same shards, as long as they are given the same durations.
+def shard(tests, index, count, durations):
+    totals = [0.0] * count
+    shard_of = {}
+    timed = sorted((test.name for test in tests if test.name in durations),
+                   key=lambda name: (-durations[name], name))
+    for name in timed:
+        i = totals.index(min(totals))
+        shard_of[name] = i
+        totals[i] += durations[name]
+
+    def in_shard(name):
+        if name in shard_of:
+            return shard_of[name] == index
+        return zlib.crc32(name.encode('utf8')) % count == index
+
+    return [test for test in tests if in_shard(test.name)]
+
+# Print the directories and ways whose test cases used the most CPU time,
+# with the CPU time spent in each phase.
+def report(phase_times, file, top=20):
+    totals = defaultdict(lambda: defaultdict(lambda: [0.0, 0.0]))
+    for (directory, ways) in phase_times.items():
+        for (way, phases) in ways.items():
+            for (phase, (wall, cpu)) in phases.items():
+                total = totals[(os.path.dirname(directory), way)][phase]
+                total[0] += wall
+                total[1] += cpu
+
+    def cpu(phases):
+        return sum(cpu for (wall, cpu) in phases.values())
+
+    def wall(phases):
+        return sum(wall for (wall, cpu) in phases.values())
+
+    all_phases = sorted(set(phase for phases in totals.values()
+                                  for phase in phases))
+    rows = sorted(totals.items(), key=lambda row: -cpu(row[1]))[:top]
+
+    file.write('Top {0} of {1} directories and ways by CPU time (seconds):\n\n'
+               .format(len(rows), len(totals)))
+    file.write('{0:>10} {1:>10}  {2}  {3}\n'.format(
+        'cpu', 'wall', ' '.join('{0:>10}'.format(p) for p in all_phases),
+        'directory (way)'))
+    for ((directory, way), phases) in rows:
+        file.write('{0:10.1f} {1:10.1f}  {2}  {3} ({4})\n'.format(
+            cpu(phases), wall(phases),
+            ' '.join('{0:10.1f}'.format(phases[p][1]) if p in phases
+                         else '{0:>10}'.format('-') for p in all_phases),
+            directory or '.', way))